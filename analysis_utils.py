@@ -3,6 +3,7 @@ from datetime import date
 import pandas as pd
 import numpy as np
 import re
+from src.catalog import CATALOG_PATH, ExperimentCatalog
 
 def config2title(config):
     return f"{config['model_name'].replace('Qwen/', '')}"
@@ -39,6 +40,13 @@ def get_experiments_with_regex(regex, base_folder="experiments"):
             good_names.append(name)
     return good_names
 
+def query_catalog(catalog_path=CATALOG_PATH, refresh=True, **filters):
+    # Scores of all the experiments matching the filters (family, size, alternatives, source, since, until, method)
+    catalog = ExperimentCatalog(catalog_path)
+    if refresh:
+        catalog.refresh()
+    return catalog.query(**filters)
+
 def convert_bt_weights_to_probs(df_weights):
     bt = pd.pivot(data=df_weights, index="iteration", columns="Item", values="BT_Score")
     bt_values = np.exp(bt.values)
@@ -0,0 +1,18 @@
+import os
+import sys
+import argparse
+
+# Add project root to sys.path to allow imports from src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.catalog import CATALOG_PATH, EXPERIMENT_FOLDERS, ExperimentCatalog
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the scores of all experiment folders in a single catalog")
+    parser.add_argument("folders", nargs="*", default=EXPERIMENT_FOLDERS, help="Folders to search for experiments")
+    parser.add_argument("--catalog", type=str, default=CATALOG_PATH, help="Path of the catalog (SQLite file)")
+    parser.add_argument("--force", action="store_true", help="Re-ingest experiments whose scores did not change")
+
+    args = parser.parse_args()
+    catalog = ExperimentCatalog(args.catalog)
+    catalog.refresh(args.folders, force=args.force)
+    print(catalog.experiments().to_string())
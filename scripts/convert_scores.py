@@ -0,0 +1,29 @@
+import os
+import sys
+import argparse
+
+# Add project root to sys.path to allow imports from src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.scores_io import SCORES_CSV, SCORES_PARQUET, convert_scores_csv
+
+def convert_folders(base_folders, remove_csv=False, overwrite=False):
+    """Converts every scores.csv under base_folders to scores.parquet."""
+    for base_folder in base_folders:
+        for root, _, files in sorted(os.walk(base_folder)):
+            if SCORES_CSV not in files:
+                continue
+            if SCORES_PARQUET in files and not overwrite:
+                print(f"Skipping {root} (already converted)")
+                continue
+            csv_size = os.path.getsize(os.path.join(root, SCORES_CSV))
+            path = convert_scores_csv(root, remove_csv=remove_csv)
+            print(f"{root}: {csv_size / 1e6:.2f} MB -> {os.path.getsize(path) / 1e6:.2f} MB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert scores.csv files to columnar scores.parquet files")
+    parser.add_argument("folders", nargs="*", default=["data", "experiments"], help="Folders to search for scores.csv files")
+    parser.add_argument("--remove_csv", action="store_true", help="Delete the csv files after conversion")
+    parser.add_argument("--overwrite", action="store_true", help="Convert folders that already have a scores.parquet")
+
+    args = parser.parse_args()
+    convert_folders(args.folders, remove_csv=args.remove_csv, overwrite=args.overwrite)
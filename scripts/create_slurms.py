@@ -3,18 +3,23 @@ import itertools
 dst_path = "scripts/slurms.sh"
 prefix = "sbatch -p bml -A bml"
 script_path = "scripts/run_data_collection.sh"
+# Creates the model artifacts once, before the data collection jobs of the family start
+prepare_script_path = "scripts/run_prepare_models.sh"
 
 nodes = ['plato1', 'plato2', 'plotinus1', 'plotinus2']
 
 parameters = {
     'm': ['gemma'],
     's':  ['1', '4', '12', '27'],
-    'a': ['colors', 'foods', 'cars', 'stocks', 'laptops', 'laptop_brands'],
+    # One sweep job per model size: the model is loaded once for all the alternatives sets
+    'a': [','.join(['colors', 'foods', 'cars', 'stocks', 'laptops', 'laptop_brands'])],
 }
 
 with open(dst_path, 'w') as f:
+    for model in parameters['m']:
+        f.write(f"PREPARE_{model}=$({prefix} --parsable {prepare_script_path} -m {model} -s {','.join(parameters['s'])})\n")
     for i, combo in enumerate(itertools.product(*parameters.values())):
         flags = " ".join(f"-{k} {v}" for k, v in zip(parameters.keys(), combo))
         node = nodes[i % len(nodes)]
-        cmd = f"{prefix} -w {node} {script_path} {flags}"
+        cmd = f"{prefix} --dependency=afterok:$PREPARE_{combo[0]} -w {node} {script_path} {flags}"
         f.write(cmd + "\n")
\ No newline at end of file
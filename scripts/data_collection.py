@@ -1,19 +1,26 @@
 import os
 import sys
+import json
+import shutil
 import argparse
 import itertools
 import huggingface
+import numpy as np
 import pandas as pd
 
 from datetime import datetime
-from tqdm.auto import tqdm
 
 # Add project root to sys.path to allow imports from src
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..','src')))
 import src.alternatives
 import src.prompts
-from src.agent import load_gemma3_agent, load_qwen2_5_agent
+from src.agent import LABEL_SCORINGS, MULTI_TOKEN_SETS, load_gemma3_agent, load_qwen2_5_agent
+from src.model import get_method_scores_batch
+from src.scheduler import score_jobs
+from src.score_cache import ScoreCache
+from src.replicas import ReplicaPool
+from src.scores_io import TOP_K, ScoresLog, read_scores, read_top_k, write_scores, write_top_k
 
 MODEL_FAMILY_ALIASES = {
     'qwen': load_qwen2_5_agent,
@@ -29,14 +36,59 @@ ALTERNATIVES_ALIASES = {
     'laptop_brands': src.alternatives.laptop_brands,
 }
 
-def collect_data(model_family, model_size, alternatives_alias):
+# Score columns of the rows: the label scores, or those of the single, group and perplexity methods (with methods)
+LABEL_SCORE_COLUMNS = ('score_a', 'score_b')
+METHOD_SCORE_COLUMNS = (
+    'score_single_a', 'score_single_b', 'score_group_a', 'score_group_b', 'score_ppl_a', 'score_ppl_b',
+)
+
+TEMPLATES_ALIASES = {
+    'options': src.prompts.options_comparisons,
+    'general': src.prompts.general_comparisons,
+    'sanity_colors': src.prompts.sanity_check_colors,
+}
+
+def shard_templates(templates, shard, n_shards):
+    """Contiguous shard of the templates, so concatenating the shards in order gives back all of them."""
+    return templates[shard * len(templates) // n_shards:(shard + 1) * len(templates) // n_shards]
+
+def collect_data(
+    model_family,
+    model_size,
+    alternatives_alias,
+    templates_alias="options",
+    use_prefix_cache=True,
+    max_batch_tokens=4096,
+    score_cache_path=None,
+    paired_order=False,
+    output_format="parquet",
+    resume_dir=None,
+    agent=None,
+    output_dir="data",
+    template_shard=None,
+    top_k=0,
+    label_scoring=None,
+    on_batch=None,
+    methods=False,
+    ):
+    # on_batch(batch, results) runs after every scored batch, before it is logged (raising in it aborts the run)
+    # methods: score the options themselves with the single, group and perplexity methods from one
+    # pass (see src.model.get_method_scores_batch) instead of the labels
     # Parameters
     items = ALTERNATIVES_ALIASES[alternatives_alias]
-    templates = src.prompts.options_comparisons
-    agent_loader = MODEL_FAMILY_ALIASES[model_family]
-    agent = agent_loader(model_size)
+    templates = TEMPLATES_ALIASES[templates_alias]
+    if template_shard is not None:
+        templates = shard_templates(templates, *template_shard)
+    if agent is None:
+        agent_loader = MODEL_FAMILY_ALIASES[model_family]
+        agent = agent_loader(model_size)
+    # A replica pool opens the score cache in its own workers
+    if methods and (isinstance(agent, ReplicaPool) or paired_order or top_k or score_cache_path):
+        raise ValueError("methods scoring runs on a single model, without paired_order, top_k or a score cache")
+    if score_cache_path and not isinstance(agent, ReplicaPool):
+        agent.score_cache = ScoreCache(score_cache_path)
     labels = ['Option 1', 'Option 2']
-    print('model_id:', agent.tokenizer.name_or_path)
+    print('model_id:', agent.model_id)
     print('labels:', labels)
     print('items:')
     for item in items:
@@ -45,35 +97,230 @@ def collect_data(model_family, model_size, alternatives_alias):
     for template in templates:
         print('-', template)
 
-    # Experiment directory
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    exp_name = f'{model_family}-{model_size}-{alternatives_alias}-{timestamp}'
-    exp_dir = os.path.join("data", exp_name)
+    # Experiment directory (an interrupted run is resumed in its own directory)
+    if resume_dir:
+        exp_dir = resume_dir
+        # A resumed run keeps scoring the labels the way it started
+        config_path = os.path.join(resume_dir, "config.json")
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                resumed_config = json.load(f)
+            if label_scoring is None:
+                label_scoring = resumed_config.get("label_scoring")
+            methods = methods or resumed_config.get("methods", False)
+    else:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        exp_name = f'{model_family}-{model_size}-{alternatives_alias}-{timestamp}'
+        exp_dir = os.path.join(output_dir, exp_name)
+    if label_scoring is None:
+        label_scoring = "sum" if alternatives_alias in MULTI_TOKEN_SETS else "last_token"
+    print('label scoring:', label_scoring)
     os.makedirs(exp_dir, exist_ok=True)
+    config = {
+        "model_id": agent.model_id,
+        "model_family": model_family,
+        "model_size": model_size,
+        "alternatives": alternatives_alias,
+        "templates": templates_alias,
+        "label_scoring": label_scoring,
+    }
+    if template_shard is not None:
+        config["template_shard"] = list(template_shard)
+    if top_k:
+        config["top_k"] = top_k
+    if methods:
+        config["methods"] = True
+    with open(os.path.join(exp_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
 
     records = []
-    for template in tqdm(templates):
+    for template in templates:
         for option_a, option_b in itertools.permutations(items, 2):
             prompt = template.format(A=option_a, B=option_b)
-            score_a, score_b = agent.query(prompt, labels=[option_a, option_b])
             records.append({
                 'template': rf'{template}',
                 'option_a': option_a,
                 'option_b': option_b,
                 'prompt': rf'{prompt}',
-                'score_a': score_a.item(),
-                'score_b': score_b.item(),
             })
-            
+    record_idx = {(r['template'], r['option_a'], r['option_b']): i for i, r in enumerate(records)}
+    # Top-k next tokens at the answer position of every record's prompt (with top_k)
+    top_k_ids = np.full((len(records), top_k), -1, dtype=np.int32)
+    top_k_log_probs = np.full((len(records), top_k), np.nan, dtype=np.float16)
+
+    score_columns = METHOD_SCORE_COLUMNS if methods else LABEL_SCORE_COLUMNS
+    # Every scored batch is appended to a crash-safe log; rows logged by an interrupted run are not rescored
+    scores_log = ScoresLog(exp_dir)
+    for chunk in scores_log.read():
+        for row in chunk:
+            i = record_idx[(row['template'], row['option_a'], row['option_b'])]
+            records[i].update({key: row[key] for key in score_columns})
+            if top_k and 'top_k_ids' in row:
+                top_k_ids[i], top_k_log_probs[i] = row['top_k_ids'], row['top_k_log_probs']
+    n_done = sum(score_columns[0] in record for record in records)
+    if n_done:
+        print(f"Resuming {exp_dir}: {n_done}/{len(records)} rows already scored")
+
+    # Score all (template, pair) jobs together in saturated batches
+    if paired_order:
+        # Both orderings of a pair form a single job with prompts [(A, B), (B, A)] and labels [A, B],
+        # so they are tokenized and batched together and share their prefix work.
+        # Its rows come back as [AB + A, BA + A, AB + B, BA + B].
+        jobs, job_records = [], []
+        for template in templates:
+            for option_a, option_b in itertools.combinations(items, 2):
+                ab = record_idx[(template, option_a, option_b)]
+                ba = record_idx[(template, option_b, option_a)]
+                if 'score_a' in records[ab] and 'score_a' in records[ba]:
+                    continue
+                jobs.append(([records[ab]['prompt'], records[ba]['prompt']], [option_a, option_b]))
+                job_records.append((ab, ba))
+
+        def set_scores(job_idx, result):
+            scores = result[0] if top_k else result
+            (ab, ba), (ab_a, ba_a, ab_b, ba_b) = job_records[job_idx], scores
+            records[ab]['score_a'], records[ab]['score_b'] = ab_a.item(), ab_b.item()
+            records[ba]['score_a'], records[ba]['score_b'] = ba_b.item(), ba_a.item()
+            if top_k:
+                top_k_ids[[ab, ba]], top_k_log_probs[[ab, ba]] = result[1].numpy(), result[2].numpy()
+    elif methods:
+        # The options are scored as continuations of the chat-wrapped prompt
+        job_records = [(i,) for i, record in enumerate(records) if score_columns[0] not in record]
+        jobs = [
+            (agent._convert_to_chat_template(records[i]['prompt']), records[i]['option_a'], records[i]['option_b'])
+            for i, in job_records
+        ]
+
+        def set_scores(job_idx, result):
+            records[job_records[job_idx][0]].update(result)
+    else:
+        job_records = [(i,) for i, record in enumerate(records) if 'score_a' not in record]
+        jobs = [(records[i]['prompt'], [records[i]['option_a'], records[i]['option_b']]) for i, in job_records]
+
+        def set_scores(job_idx, result):
+            scores = result[0] if top_k else result
+            i = job_records[job_idx][0]
+            records[i]['score_a'], records[i]['score_b'] = scores[0].item(), scores[1].item()
+            if top_k:
+                top_k_ids[i], top_k_log_probs[i] = result[1][0].numpy(), result[2][0].numpy()
+
+    def log_batch(batch, results):
+        if on_batch is not None:
+            on_batch(batch, results)
+        for job_idx in batch:
+            set_scores(job_idx, results[job_idx])
+        rows = []
+        for job_idx in batch:
+            for i in job_records[job_idx]:
+                row = {key: records[i][key] for key in ('template', 'option_a', 'option_b', *score_columns)}
+                if top_k:
+                    row['top_k_ids'], row['top_k_log_probs'] = top_k_ids[i].tolist(), top_k_log_probs[i].tolist()
+                rows.append(row)
+        scores_log.append(rows)
+
+    score_kwargs = dict(
+        max_batch_tokens=max_batch_tokens, use_prefix_cache=use_prefix_cache, on_batch=log_batch, top_k=top_k,
+        label_scoring=label_scoring,
+    )
+    if methods:
+        scores = get_method_scores_batch(
+            agent.model, agent.tokenizer, jobs, max_batch_tokens=max_batch_tokens,
+            use_prefix_cache=use_prefix_cache, on_batch=log_batch,
+        )
+    elif isinstance(agent, ReplicaPool):
+        scores = agent.score_jobs(jobs, **score_kwargs)
+    else:
+        scores = score_jobs(agent, jobs, **score_kwargs)
+    # Jobs served by the score cache never went through a batch
+    for job_idx, job_scores in enumerate(scores):
+        set_scores(job_idx, job_scores)
+
     df = pd.DataFrame(records)
-    df.to_csv(os.path.join(exp_dir, f"scores.csv"), index=False)
+    print("Saved scores to", write_scores(df, exp_dir, file_format=output_format))
+    if top_k:
+        print("Saved top-k next tokens to", write_top_k(exp_dir, top_k_ids, top_k_log_probs))
+    scores_log.close(remove=True)
     print("Finished!")
 
+def merge_shards(exp_dir, n_shards, output_format="parquet"):
+    """Merges the template shards exp_dir/shard-<k> of an experiment into a single scores file in exp_dir."""
+    shard_dirs = [os.path.join(exp_dir, f"shard-{shard}") for shard in range(n_shards)]
+    df = pd.concat([read_scores(shard_dir) for shard_dir in shard_dirs], ignore_index=True)
+    with open(os.path.join(shard_dirs[0], "config.json")) as f:
+        config = json.load(f)
+    config.pop("template_shard", None)
+    with open(os.path.join(exp_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+    path = write_scores(df, exp_dir, file_format=output_format)
+    if all(os.path.exists(os.path.join(shard_dir, TOP_K)) for shard_dir in shard_dirs):
+        shards_top_k = [read_top_k(shard_dir) for shard_dir in shard_dirs]
+        write_top_k(exp_dir, *(np.concatenate(arrays) for arrays in zip(*shards_top_k)))
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+    print(f"Merged {n_shards} shards into {path}")
+    return path
+
+def collect_sweep(model_family, model_size, alternatives_aliases, templates_aliases=("options",), n_replicas=1,
+                  **kwargs):
+    """
+    Runs collect_data for every (template family, alternatives set) with a single model load.
+    Each set gets its own experiment folder; with several template families, the folders of a family
+    go to data/<templates alias>. With n_replicas > 1, small models are loaded once per worker process
+    and the jobs are split across the replicas (see src.replicas). kwargs are passed to collect_data.
+    """
+    agent_loader = MODEL_FAMILY_ALIASES[model_family]
+    if n_replicas > 1:
+        agent = ReplicaPool(agent_loader, (model_size,), n_replicas, score_cache_path=kwargs.get("score_cache_path"))
+    else:
+        agent = agent_loader(model_size)
+    try:
+        for templates_alias in templates_aliases:
+            output_dir = "data" if len(templates_aliases) == 1 else os.path.join("data", templates_alias)
+            for alternatives_alias in alternatives_aliases:
+                print(f"=== {model_family}-{model_size}: {alternatives_alias} ({templates_alias} templates) ===")
+                collect_data(
+                    model_family, model_size, alternatives_alias, templates_alias,
+                    agent=agent, output_dir=output_dir, **kwargs,
+                )
+    finally:
+        if n_replicas > 1:
+            agent.close()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run Data")
     parser.add_argument("--model_family", type=str, required=True, help="Model family")
     parser.add_argument("--model_size", type=str, required=True, help="Model size")
-    parser.add_argument("--alternatives", type=str, required=True, help="Alternatives alias")
+    parser.add_argument("--alternatives", type=str, required=True, help="Alternatives alias or comma-separated list (sweep)")
+    parser.add_argument("--templates", type=str, default="options", help="Templates alias or comma-separated list (sweep)")
+    parser.add_argument("--no_prefix_cache", action="store_true", help="Re-encode the full prompt for every label")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="Padded tokens per forward pass")
+    parser.add_argument("--score_cache", type=str, default=None, help="Path of a persistent score cache (SQLite file)")
+    parser.add_argument("--paired_order", action="store_true", help="Score both orderings of every pair together")
+    parser.add_argument("--output_format", type=str, default="parquet", choices=["parquet", "csv"], help="Format of the scores file")
+    parser.add_argument("--n_replicas", type=int, default=1, help="Model replicas scoring in parallel (small models)")
+    parser.add_argument("--resume", type=str, default=None, help="Directory of an interrupted run to resume")
+    parser.add_argument("--top_k", type=int, default=0, help="Also save the top-k next tokens at the answer position")
+    parser.add_argument("--label_scoring", type=str, default=None, choices=LABEL_SCORINGS, help="Score the last label token, or the sum / mean over all of them (default: sum for multi-token sets)")
+    parser.add_argument("--methods", action="store_true", help="Score the options with the single, group and perplexity methods (score_single_*, score_group_*, score_ppl_*) in one pass")
 
     args = parser.parse_args()
-    collect_data(args.model_family, args.model_size, args.alternatives)
\ No newline at end of file
+    alternatives_aliases = args.alternatives.split(",")
+    templates_aliases = args.templates.split(",")
+    if args.resume and (len(alternatives_aliases) > 1 or len(templates_aliases) > 1):
+        parser.error("--resume resumes a single experiment folder, not a sweep")
+    collect_sweep(
+        args.model_family,
+        args.model_size,
+        alternatives_aliases,
+        templates_aliases,
+        n_replicas=args.n_replicas,
+        use_prefix_cache=not args.no_prefix_cache,
+        max_batch_tokens=args.max_batch_tokens,
+        score_cache_path=args.score_cache,
+        paired_order=args.paired_order,
+        output_format=args.output_format,
+        resume_dir=args.resume,
+        top_k=args.top_k,
+        label_scoring=args.label_scoring,
+        methods=args.methods,
+    )
@@ -0,0 +1,38 @@
+import os
+import sys
+import torch
+import argparse
+import huggingface_hub
+
+from dotenv import load_dotenv
+
+# Add project root to sys.path to allow imports from src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.agent import gemma3_model_id, qwen2_5_model_id
+from src.model_artifacts import ARTIFACTS_DIR, prepare_model_artifact
+
+MODEL_ID_ALIASES = {
+    'qwen': qwen2_5_model_id,
+    'gemma': gemma3_model_id,
+}
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Download models and store them as local safetensors artifacts, loaded by the agents instead of the hub"
+    )
+    parser.add_argument("--model_family", type=str, required=True, help="Model family")
+    parser.add_argument("--model_sizes", type=str, required=True, help="Comma-separated model sizes")
+    parser.add_argument("--artifacts", type=str, default=os.getenv("MODEL_ARTIFACTS", ARTIFACTS_DIR), help="Root folder of the artifacts")
+    parser.add_argument("--dtype", type=str, default=None, choices=["float16", "float32"], help="dtype of the stored weights, the one the agents load: float16 for GPU runs, float32 for CPU runs (default: that of this machine)")
+
+    args = parser.parse_args()
+    if os.getenv("HF_TOKEN"):
+        huggingface_hub.login(token=os.getenv("HF_TOKEN"))
+    cache_dir = os.path.join(os.getcwd(), "huggingface", ".cache")
+    # Same dtype as HFAgent on this machine unless specified
+    dtype = getattr(torch, args.dtype) if args.dtype else (torch.float16 if torch.cuda.is_available() else torch.float32)
+    for model_size in args.model_sizes.split(","):
+        model_id = MODEL_ID_ALIASES[args.model_family](model_size)
+        path = prepare_model_artifact(args.artifacts, model_id, dtype=dtype, cache_dir=cache_dir)
+        print(f"{model_id}: {path}")
@@ -20,6 +20,10 @@ while [[ $# -gt 0 ]]; do
       ALTERNATIVES="$2"
       shift 2
       ;;
+    -t|--templates)
+      TEMPLATES="$2"
+      shift 2
+      ;;
     *)
       echo "Unknown option $1"
       exit 1
@@ -29,6 +33,8 @@ done
 
 source /home/lotan.amit/miniconda3/etc/profile.d/conda.sh
 conda activate /home/lotan.amit/miniconda3/envs/whatdo-llms-want
+# Models with a local safetensors artifact (huggingface/artifacts, or $MODEL_ARTIFACTS if set) are loaded
+# from it, others from the hub. Artifacts are created beforehand by scripts/run_prepare_models.sh (see slurms.sh)
 
 # Build command array
 CMD=(python3 scripts/data_collection.py)
@@ -45,6 +51,10 @@ if [ -n "$ALTERNATIVES" ]; then
     CMD+=(--alternatives "$ALTERNATIVES")
 fi
 
+if [ -n "$TEMPLATES" ]; then
+    CMD+=(--templates "$TEMPLATES")
+fi
+
 # Execute command
 "${CMD[@]}"
 
@@ -6,13 +6,14 @@ import os
 from datetime import datetime
 
 import pandas as pd
-from tqdm import tqdm
 # Add project root to sys.path to allow imports from src
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src import prompts, alternatives
 # from src.experiment import collect_preference_data, fit_pref_models
-from src.agent import InstructedHFAgent, PretrainedAgent, agent_factory
+from src.agent import LABEL_SCORINGS, MULTI_TOKEN_SETS, InstructedHFAgent, PretrainedAgent, agent_factory
+from src.scheduler import score_jobs
+from src.scores_io import ScoresLog, write_scores
 
 
 MODEL_ALIASES = {
@@ -81,12 +82,18 @@ def main(
     alternatives,
     templates,
     pairwise=True,
-    cluster_job=None
+    cluster_job=None,
+    max_batch_tokens=4096,
+    output_format="parquet",
+    label_scoring=None,
     ):
 
     print(f"Running experiment with model: {model}")
     print(f"Alternatives: {alternatives}")
     print(f"Templates: {templates}")
+    if label_scoring is None:
+        label_scoring = "sum" if alternatives in MULTI_TOKEN_SETS else "last_token"
+    print(f"Label scoring: {label_scoring}")
     
     dir_path = os.path.join("experiments", exp_name)
     os.makedirs(dir_path, exist_ok=True)
@@ -96,6 +103,7 @@ def main(
             "model_name": model,
             "alternatives": alternatives,
             "templates": templates,
+            "label_scoring": label_scoring,
         }, f, indent=4)
 
     model_cls, model_size, model_instruct = MODEL_ALIASES.get(model, model)
@@ -106,26 +114,64 @@ def main(
     agent = agent_factory(model_cls, model_size, model_instruct)
     print(f"Loaded model: {agent.model_id}")
     
-    def query_all_pairs(agent, alternatives, template):
-        results = []
-        for a1, a2 in itertools.combinations(alternatives, 2):
-            scores = agent.query(template, [a1, a2])
-            # Store or process scores as needed
-            results.append({
+    records = []
+    # (index of item_a, index of item_b) in the alternatives of every record
+    record_items = []
+    for i, template in enumerate(templates):
+        for (idx_a, a1), (idx_b, a2) in itertools.combinations(enumerate(alternatives), 2):
+            records.append({
                 "template": template,
                 "item_a": a1,
                 "item_b": a2,
-                "score_a": scores[0],
-                "score_b": scores[1]
+                "iteration": i,
             })
-        return pd.DataFrame(results)
+            record_items.append((idx_a, idx_b))
 
-    pref_data = pd.DataFrame()
-    for i, template in tqdm(enumerate(templates)):
-        current_data = query_all_pairs(agent, alternatives, template)
-        pref_data = pd.concat([pref_data, current_data.assign(iteration=i)], ignore_index=True)
+    # Every scored batch is appended to a crash-safe log; rerunning with the same exp_name resumes the run
+    scores_log = ScoresLog(dir_path)
+    record_idx = {(r["template"], r["item_a"], r["item_b"]): i for i, r in enumerate(records)}
+    for chunk in scores_log.read():
+        for row in chunk:
+            records[record_idx[(row["template"], row["item_a"], row["item_b"])]].update(row)
+    pending = [i for i, record in enumerate(records) if "score_a" not in record]
+    if len(pending) < len(records):
+        print(f"Resuming {exp_name}: {len(records) - len(pending)}/{len(records)} rows already scored")
+
+    if pairwise:
+        # Score all (template, pair) jobs together in saturated batches
+        jobs = [(records[i]["template"], [records[i]["item_a"], records[i]["item_b"]]) for i in pending]
+        # (record, index of the item_a score, index of the item_b score) filled by every job
+        job_records = [[(i, 0, 1)] for i in pending]
+    else:
+        # A task prompt does not depend on the pair: every alternative is scored once per task,
+        # as a list sharing the prompt's prefix cache, and all the pairs are read from that list
+        task_records = {}
+        for i in pending:
+            task_records.setdefault(records[i]["iteration"], []).append((i, *record_items[i]))
+        jobs = [(templates[task], alternatives) for task in task_records]
+        job_records = list(task_records.values())
+
+    def set_scores(job_idx, scores):
+        scores = scores.tolist()
+        for i, idx_a, idx_b in job_records[job_idx]:
+            records[i]["score_a"], records[i]["score_b"] = scores[idx_a], scores[idx_b]
+
+    def log_batch(batch, results):
+        for job_idx in batch:
+            set_scores(job_idx, results[job_idx])
+        scores_log.append([records[i] for job_idx in batch for i, _, _ in job_records[job_idx]])
+
+    scores = score_jobs(
+        agent, jobs, max_batch_tokens=max_batch_tokens, use_prefix_cache=not pairwise, on_batch=log_batch,
+        label_scoring=label_scoring,
+    )
+    for job_idx, job_scores in enumerate(scores):
+        set_scores(job_idx, job_scores)
+
+    pref_data = pd.DataFrame(records, columns=["template", "item_a", "item_b", "score_a", "score_b", "iteration"])
         
-    pref_data.to_csv(f"experiments/{exp_name}/scores.csv", index=False)
+    write_scores(pref_data, dir_path, file_format=output_format)
+    scores_log.close(remove=True)
     print(f"Finished with {len(pref_data)} preference data points.")
     
 if __name__ == "__main__":
@@ -137,6 +183,9 @@ if __name__ == "__main__":
     parser.add_argument("--pairwise", action="store_true", default=True, help="Use pairwise comparisons (default: True)")
     parser.add_argument("--task", action="store_true", help="Run in task mode (pairwise=False)")
     parser.add_argument("--exp_name", type=str, default=None, help="Experiment name")
+    parser.add_argument("--max_batch_tokens", type=int, default=4096, help="Padded tokens per forward pass")
+    parser.add_argument("--output_format", type=str, default="parquet", choices=["parquet", "csv"], help="Format of the scores file")
+    parser.add_argument("--label_scoring", type=str, default=None, choices=LABEL_SCORINGS, help="Score the last label token, or the sum / mean over all of them (default: sum for multi-token sets)")
 
     args = parser.parse_args()
 
@@ -153,5 +202,8 @@ if __name__ == "__main__":
         args.alternatives,
         args.templates,
         pairwise,
-        args.cluster_job
+        args.cluster_job,
+        args.max_batch_tokens,
+        args.output_format,
+        args.label_scoring,
     )
@@ -0,0 +1,35 @@
+#!/bin/bash
+
+#SBATCH -c 8
+# The weights are loaded on CPU in the stored dtype (~2 bytes per parameter in float16: ~55G for 27B)
+#SBATCH --mem=128G
+#SBATCH -o ./out/%j.txt
+#SBATCH -e ./err/%j.txt
+
+while [[ $# -gt 0 ]]; do
+  case $1 in
+    -m|--models)
+      MODEL="$2"
+      shift 2
+      ;;
+    -s|--sizes)
+      SIZES="$2"
+      shift 2
+      ;;
+    -d|--dtype)
+      DTYPE="$2"
+      shift 2
+      ;;
+    *)
+      echo "Unknown option $1"
+      exit 1
+      ;;
+  esac
+done
+
+source /home/lotan.amit/miniconda3/etc/profile.d/conda.sh
+conda activate /home/lotan.amit/miniconda3/envs/whatdo-llms-want
+# The data collection jobs run on GPU, in float16
+python3 scripts/prepare_models.py --model_family "$MODEL" --model_sizes "$SIZES" --dtype "${DTYPE:-float16}"
+
+# sbatch -p bml -A bml scripts/run_prepare_models.sh -m {model} -s {sizes} [-d {dtype}]
@@ -0,0 +1,199 @@
+import os
+import sys
+import gc
+import time
+import socket
+import argparse
+import itertools
+import traceback
+import multiprocessing
+
+from datetime import datetime
+
+# Add project root to sys.path to allow imports from src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..','src')))
+from src.agent import LABEL_SCORINGS
+from data_collection import (
+    ALTERNATIVES_ALIASES, MODEL_FAMILY_ALIASES, TEMPLATES_ALIASES, collect_data, merge_shards, shard_templates
+)
+from src.scores_io import scores_path
+from src.work_queue import ClaimLost, Heartbeat, WorkQueue
+
+def unit_cost(model_size, items, templates):
+    """Rough cost of a unit: model size x prompt characters to score (one prompt per template and ordered pair)."""
+    n_chars = sum(
+        len(template) + len(option_a) + len(option_b)
+        for template in templates
+        for option_a, option_b in itertools.permutations(items, 2)
+    )
+    return float(model_size) * n_chars
+
+def create_units(queue_path, model_family, model_sizes, alternatives_aliases, templates_aliases=("options",),
+                 n_shards=1, output_dir="data"):
+    """Adds the units of a (model size x alternatives set x template family) sweep, split in n_shards template shards."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    units = []
+    for model_size, alternatives_alias, templates_alias in itertools.product(
+        model_sizes, alternatives_aliases, templates_aliases
+    ):
+        base_dir = output_dir if len(templates_aliases) == 1 else os.path.join(output_dir, templates_alias)
+        exp_dir = os.path.join(base_dir, f'{model_family}-{model_size}-{alternatives_alias}-{timestamp}')
+        for shard in range(n_shards):
+            templates = shard_templates(TEMPLATES_ALIASES[templates_alias], shard, n_shards)
+            units.append({
+                'model_family': model_family,
+                'model_size': str(model_size),
+                'alternatives': alternatives_alias,
+                'templates': templates_alias,
+                'shard': shard,
+                'n_shards': n_shards,
+                'exp_dir': exp_dir,
+                'cost': unit_cost(model_size, ALTERNATIVES_ALIASES[alternatives_alias], templates),
+            })
+    n_added = WorkQueue(queue_path).add_units(units)
+    print(f"Added {n_added} units to {queue_path}")
+
+def work(queue_path, worker=None, max_model_size=None, wait=False, heartbeat_interval=60, stale_after=600, **kwargs):
+    """
+    Claims and scores units until the queue is empty (or, with wait, until no unit is pending or running,
+    so units requeued from dead workers are picked up too). The loaded model is kept across units.
+    A unit whose worker missed its heartbeats for stale_after seconds is requeued; if that worker is still
+    alive, it stops scoring the unit at its next batch and leaves it to the new claimant.
+    kwargs are passed to collect_data.
+    """
+    queue = WorkQueue(queue_path, stale_after=stale_after)
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    agent, model = None, None
+    n_done = 0
+    while True:
+        unit = queue.claim(worker, model=model, max_model_size=max_model_size)
+        if unit is None:
+            if wait and queue.n_active():
+                time.sleep(heartbeat_interval)
+                continue
+            break
+        print(f"[{worker}] unit {unit['id']}: {unit['exp_dir']} (shard {unit['shard'] + 1}/{unit['n_shards']})")
+        sharded = unit['n_shards'] > 1
+        unit_dir = os.path.join(unit['exp_dir'], f"shard-{unit['shard']}") if sharded else unit['exp_dir']
+        try:
+            # Loading a big model can take longer than stale_after, so the claim is kept alive meanwhile
+            with Heartbeat(queue, unit['id'], worker, interval=heartbeat_interval) as heartbeat:
+                if (unit['model_family'], unit['model_size']) != model:
+                    # Free the previous model before loading the next one
+                    agent, model = None, None
+                    gc.collect()
+                    agent = MODEL_FAMILY_ALIASES[unit['model_family']](unit['model_size'])
+                    model = (unit['model_family'], unit['model_size'])
+                heartbeat.check()
+                # A requeued unit resumes from the scores log its previous worker left in unit_dir;
+                # a unit requeued after a failed merge already has its scores file
+                if scores_path(unit_dir) is None:
+                    collect_data(
+                        unit['model_family'], unit['model_size'], unit['alternatives'], unit['templates'],
+                        agent=agent, resume_dir=unit_dir,
+                        template_shard=(unit['shard'], unit['n_shards']) if sharded else None,
+                        on_batch=lambda batch, results: heartbeat.check(),
+                        **kwargs,
+                    )
+            if queue.complete(unit['id'], worker) and sharded:
+                # A failed merge puts the unit back in the queue (as pending), so the merge is retried
+                merge_shards(unit['exp_dir'], unit['n_shards'], output_format=kwargs.get('output_format', 'parquet'))
+        except ClaimLost as e:
+            print(f"[{worker}] {e}, leaving it to its new worker")
+            continue
+        except Exception as e:
+            traceback.print_exc()
+            queue.fail(unit['id'], worker, repr(e))
+            continue
+        n_done += 1
+    print(f"[{worker}] no more units, scored {n_done}")
+
+def _local_worker(queue_path, worker, gpu, kwargs):
+    if gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
+    work(queue_path, worker=worker, **kwargs)
+
+def run_local(queue_path, n_workers, n_gpus=0, **kwargs):
+    """Runs n_workers worker processes on this machine (worker i on GPU i % n_gpus when n_gpus > 0)."""
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(
+            target=_local_worker,
+            args=(queue_path, f"{socket.gethostname()}-local-{i}", i % n_gpus if n_gpus else None, kwargs),
+        )
+        for i in range(n_workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def print_status(queue_path):
+    status = WorkQueue(queue_path).status()
+    print(status.groupby('status').agg(units=('id', 'count'), cost=('cost', 'sum')))
+    print(status[['id', 'exp_dir', 'shard', 'status', 'worker', 'attempts', 'error']].to_string(index=False))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distribute data collection over workers through a shared work queue")
+    parser.add_argument("--queue", type=str, required=True, help="Path of the queue (SQLite file on shared storage)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="Add the units of a sweep to the queue")
+    create_parser.add_argument("--model_family", type=str, required=True, help="Model family")
+    create_parser.add_argument("--model_sizes", type=str, required=True, help="Comma-separated model sizes")
+    create_parser.add_argument("--alternatives", type=str, required=True, help="Comma-separated alternatives aliases")
+    create_parser.add_argument("--templates", type=str, default="options", help="Comma-separated templates aliases")
+    create_parser.add_argument("--n_shards", type=int, default=1, help="Template shards per experiment")
+    create_parser.add_argument("--output_dir", type=str, default="data", help="Folder of the experiments")
+
+    for name, help_text in [("work", "Score units until the queue is empty"),
+                            ("local", "Run several workers on this machine")]:
+        worker_parser = subparsers.add_parser(name, help=help_text)
+        worker_parser.add_argument("--max_model_size", type=float, default=None, help="Skip units of bigger models")
+        worker_parser.add_argument("--wait", action="store_true", help="Wait for running units of other workers")
+        worker_parser.add_argument("--heartbeat_interval", type=float, default=60, help="Seconds between heartbeats")
+        worker_parser.add_argument("--stale_after", type=float, default=600, help="Seconds without heartbeat before a unit is requeued")
+        worker_parser.add_argument("--no_prefix_cache", action="store_true", help="Re-encode the full prompt for every label")
+        worker_parser.add_argument("--max_batch_tokens", type=int, default=4096, help="Padded tokens per forward pass")
+        worker_parser.add_argument("--score_cache", type=str, default=None, help="Path of a persistent score cache (SQLite file)")
+        worker_parser.add_argument("--paired_order", action="store_true", help="Score both orderings of every pair together")
+        worker_parser.add_argument("--output_format", type=str, default="parquet", choices=["parquet", "csv"], help="Format of the scores file")
+        worker_parser.add_argument("--top_k", type=int, default=0, help="Also save the top-k next tokens at the answer position")
+        worker_parser.add_argument("--label_scoring", type=str, default=None, choices=LABEL_SCORINGS, help="Score the last label token, or the sum / mean over all of them (default: sum for multi-token sets)")
+    subparsers.choices["local"].add_argument("--n_workers", type=int, default=2, help="Number of worker processes")
+    subparsers.choices["local"].add_argument("--n_gpus", type=int, default=0, help="GPUs to spread the workers over")
+
+    subparsers.add_parser("status", help="Show the state of the units")
+
+    args = parser.parse_args()
+    if args.command == "create":
+        create_units(
+            args.queue,
+            args.model_family,
+            args.model_sizes.split(","),
+            args.alternatives.split(","),
+            args.templates.split(","),
+            n_shards=args.n_shards,
+            output_dir=args.output_dir,
+        )
+    elif args.command == "status":
+        print_status(args.queue)
+    else:
+        kwargs = dict(
+            max_model_size=args.max_model_size,
+            wait=args.wait,
+            heartbeat_interval=args.heartbeat_interval,
+            stale_after=args.stale_after,
+            use_prefix_cache=not args.no_prefix_cache,
+            max_batch_tokens=args.max_batch_tokens,
+            score_cache_path=args.score_cache,
+            paired_order=args.paired_order,
+            output_format=args.output_format,
+            top_k=args.top_k,
+            label_scoring=args.label_scoring,
+        )
+        if args.command == "work":
+            work(args.queue, **kwargs)
+        else:
+            run_local(args.queue, args.n_workers, n_gpus=args.n_gpus, **kwargs)
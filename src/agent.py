@@ -1,12 +1,21 @@
 import os
 import torch
 import huggingface_hub
-import torch.nn.functional as F
 
 from dotenv import load_dotenv
 from typing import List
 from abc import ABC, abstractmethod
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from src.token_cache import TokenizationCache
+from src.model_artifacts import ARTIFACTS_DIR, artifact_path, load_model_artifact
+
+# How a label spanning several tokens is scored: the log probability of its last token only,
+# or the sum / mean of the log probabilities of all its tokens
+LABEL_SCORINGS = ["last_token", "sum", "mean"]
+# Alternatives sets (aliases of the data collection and experiment scripts) whose items span several
+# tokens: scored by the log-likelihood of all their tokens ("sum") by default
+MULTI_TOKEN_SETS = ["gifts", "laptops"]
+
 class Agent(ABC):
     @abstractmethod
     def query(self, prompt: str, labels: List[str]) -> List[float]:
@@ -14,13 +23,14 @@ class Agent(ABC):
 
 class HFAgent(Agent):
     SYSTEM_MESSAGE = "You are a helpful assistant. Answer shortly with only your choice with no explanation.\n\n"
+    # Optional src.score_cache.ScoreCache consulted before running the model
+    score_cache = None
     
-    def __init__(self, model_id):
+    def __init__(self, model_id, device_map="auto"):
         load_dotenv()
-        huggingface_hub.login(token=os.getenv("HF_TOKEN"))
         self.model_id = model_id
         self.system_prompt = self.SYSTEM_MESSAGE
-        self.model, self.tokenizer = self._load_model_and_tokenizer(model_id)
+        self.model, self.tokenizer = self._load_model_and_tokenizer(model_id, device_map=device_map)
     
     @classmethod
     def with_model(cls, model, tokenizer):
@@ -33,50 +43,74 @@ class HFAgent(Agent):
         
         return new_agent
 
+    @property
+    def model_info(self):
+        """Identifies the weights producing the scores (used in score cache keys)."""
+        return {
+            "model_id": getattr(self, "model_id", None),
+            "revision": getattr(self.model.config, "_commit_hash", None),
+            "dtype": str(self.model.dtype),
+        }
+
+    @property
+    def token_cache(self):
+        """Chat wrapping and token ids of the prompts and labels already seen (see src.token_cache)."""
+        cache = getattr(self, "_token_cache", None)
+        if cache is None or cache.tokenizer is not self.tokenizer:
+            cache = self._token_cache = TokenizationCache(self.tokenizer)
+        return cache
+
     def _convert_to_chat_template(self, text):
-        messages = [
-            {
-                "role": "system",
-                "content": self.system_prompt
-            },
-            {
-                "role": "user",
-                "content": text
-            }
-        ]
-        return self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
+        return self.token_cache.chat_text(self.system_prompt, text)
 
     @staticmethod
-    def _load_model_and_tokenizer(model_id, cache_dir=None):
-        """Loads the model and tokenizer."""
+    def _load_model_and_tokenizer(model_id, cache_dir=None, device_map="auto"):
+        """
+        Loads the model and tokenizer.
+        device_map is only used on GPU: "auto" spreads the model over all visible GPUs,
+        {"": i} puts a full copy on GPU i (see src.replicas).
+        Models with an artifact in MODEL_ARTIFACTS (environment or .env, huggingface/artifacts by default)
+        are loaded from it, already in the target dtype and with their saved device map (see
+        src.model_artifacts), without the hub or a login. Artifacts are only created beforehand, by
+        scripts/prepare_models.py (loading never writes one, since the jobs and replicas of a sweep would
+        all write it at the same time); models without one are loaded from the hub.
+        """
         cwd = os.getcwd()
         cache_dir = cwd + "/huggingface/.cache"
         os.makedirs(cache_dir, exist_ok=True)
+        artifacts_dir = os.getenv("MODEL_ARTIFACTS")
 
-        print(f"Loading {model_id}...")
-        tokenizer = AutoTokenizer.from_pretrained(model_id)
         # Use float16 or bfloat16 for efficiency if GPU is available
         
         if torch.cuda.is_available():
             num_gpus = torch.cuda.device_count()
             print(f"Found {num_gpus} GPUs.")
-            if num_gpus > 8:
+            if num_gpus > 8 and device_map == "auto":
                 print("Warning: Using > 8 GPUs may cause peer mapping errors. Consider reducing GPU count.")
-            device_map = "auto"
             device = "cuda"
         else:
             print("No GPU found. Running on CPU (not recommended for large models).")
             device_map = None
             device = "cpu"
+        dtype = torch.float16 if device == "cuda" else torch.float32
+
+        loaded = load_model_artifact(artifacts_dir or ARTIFACTS_DIR, model_id, dtype, device_map=device_map)
+        if loaded is not None:
+            return loaded
+        if artifacts_dir:
+            print(
+                f"Warning: no artifact of {model_id} ({dtype}) in {artifact_path(artifacts_dir, model_id, dtype)}, "
+                f"loading it from the hub (create it with scripts/prepare_models.py)"
+            )
 
+        if os.getenv("HF_TOKEN"):
+            huggingface_hub.login(token=os.getenv("HF_TOKEN"))
+        print(f"Loading {model_id}...")
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
         model = AutoModelForCausalLM.from_pretrained(
             model_id,
             cache_dir=cache_dir,
-            dtype=torch.float16 if device == "cuda" else torch.float32,
+            dtype=dtype,
             device_map=device_map,
             low_cpu_mem_usage=True
         )
@@ -85,67 +119,344 @@ class HFAgent(Agent):
         return model, tokenizer
 
 class InstructedHFAgent(HFAgent):
-    def query(self, prompts, labels):
+    def query(self, prompts, labels, use_prefix_cache=False, label_scoring="last_token"):
+        prefix_groups = self.prompt_groups(prompts, labels)
+        if self.score_cache is None:
+            input_ids, labels_tokens = self.encode_query(prompts, labels, label_scoring)
+            return self.score_rows(
+                input_ids, labels_tokens, use_prefix_cache=use_prefix_cache, prefix_groups=prefix_groups,
+                label_scoring=label_scoring,
+            )
+
+        # Only run the model for the rows missing from the score cache
+        keys = self.cache_keys(prompts, labels, label_scoring)
+        cached = self.score_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            input_ids, labels_tokens = self.encode_query(prompts, labels, label_scoring)
+            scores = self.score_rows(
+                [input_ids[i] for i in missing],
+                [labels_tokens[i] for i in missing],
+                use_prefix_cache=use_prefix_cache,
+                prefix_groups=[prefix_groups[i] for i in missing],
+                label_scoring=label_scoring,
+            ).float().cpu()
+            new_scores = {keys[i]: score.item() for i, score in zip(missing, scores)}
+            self.score_cache.put_many(new_scores.items())
+            cached.update(new_scores)
+        return torch.tensor([cached[key] for key in keys])
+
+    @staticmethod
+    def prompt_groups(prompts, labels):
+        """Index of the prompt of every row of a query, in the same order as encode_query."""
+        n_prompts = len(prompts) if isinstance(prompts, list) else 1
+        return [i for _ in labels for i in range(n_prompts)]
+
+    def answer_positions(self, prompts, labels):
+        """
+        Position of the answer (the last prompt token, whose next-token distribution the first label
+        token is drawn from) in every row of a query, in the same order as encode_query.
+        """
+        if not isinstance(prompts, list):
+            prompts = [prompts]
+        positions = [len(self.token_cache.prompt_ids(self._convert_to_chat_template(p))) - 1 for p in prompts]
+        return [position for _ in labels for position in positions]
+
+    def cache_keys(self, prompts, labels, label_scoring="last_token"):
+        """Score cache keys of the rows of a query, in the same order as encode_query."""
         if not isinstance(prompts, list):
             prompts = [prompts]
         prompts = [self._convert_to_chat_template(p) for p in prompts]
-        # concat labels to the corrposnded input text
-        input_with_answers = [i + label for label in labels for i in prompts]
+        model_info = self.model_info
+        return [
+            self.score_cache.make_key(model_info, self.system_prompt, prompt, label, method=label_scoring)
+            for label in labels for prompt in prompts
+        ]
+
+    def encode_query(self, prompts, labels, label_scoring="last_token"):
+        """
+        Tokenizes the rows of a query without padding.
+        Returns the token ids of every (label, prompt) row and the label tokens scored in it,
+        which always end the row: the label's last token only with label_scoring="last_token",
+        all of its tokens otherwise.
+        """
+        if label_scoring not in LABEL_SCORINGS:
+            raise ValueError(f"label_scoring must be one of {LABEL_SCORINGS}, got {label_scoring!r}")
+        if not isinstance(prompts, list):
+            prompts = [prompts]
+        prompts = [self._convert_to_chat_template(p) for p in prompts]
+        token_cache = self.token_cache
         # get labels tokens ids
-        labels_tokens = self.tokenizer(labels, add_special_tokens=False)["input_ids"]
-        # get the last token id of each label
-        labels_tokens = [label[-1] for label in labels_tokens]
+        labels_ids = token_cache.label_ids(labels)
+        # concat labels to the corrposnded input text
+        input_ids = [token_cache.row_ids(prompt, label) for label in labels for prompt in prompts]
+        if label_scoring == "last_token":
+            # get the last token id of each label, once per row
+            return input_ids, [[label[-1]] for label in labels_ids for _ in prompts]
+
+        # Take the label tokens from the row itself: the label may merge with the end
+        # of the prompt differently than when it is tokenized alone
+        prompts_ids = [token_cache.prompt_ids(prompt) for prompt in prompts]
+        rows = iter(input_ids)
+        labels_tokens = []
+        for label_ids in labels_ids:
+            for prompt_ids in prompts_ids:
+                row = next(rows)
+                if row[:len(prompt_ids)] == prompt_ids and len(row) > len(prompt_ids):
+                    labels_tokens.append(row[len(prompt_ids):])
+                else:
+                    labels_tokens.append(row[-len(label_ids):])
+        return input_ids, labels_tokens
+
+    def score_rows(self, input_ids, labels_tokens, use_prefix_cache=False, prefix_groups=None,
+                   label_scoring="last_token", top_k=0, answer_positions=None, answer_token_ids=None):
+        """
+        Scores already tokenized rows (possibly coming from many different queries) in a single
+        forward pass. labels_tokens[i] are the label tokens ending row i (see encode_query); row i is
+        scored by their log probability, summed (or averaged with label_scoring="mean") over the tokens.
+        With use_prefix_cache, rows sharing a prefix group id (e.g. the rows of one prompt) encode
+        their common prefix only once.
+
+        With top_k > 0, the top_k next-token ids and log probabilities at answer_positions[i]
+        (see answer_positions) are captured from the same pass, once per prefix group, and
+        (scores, top_k_ids, top_k_log_probs) is returned, with (n_rows, top_k) int32 / float16 arrays.
+        With answer_token_ids (a list of token ids per row), the log probabilities of those tokens at
+        the answer position of their row are appended to the returned tuple, as a float tensor on CPU
+        padded with -inf to the longest list.
+        """
         # Ensure pad token exists before padding
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-        # Get encodings for each input text using direct call instead of batch_encode_plus
-        input_enc = self.tokenizer(
-            input_with_answers,
-            return_tensors="pt",
-            padding="longest",
-        )
+
+        if use_prefix_cache:
+            return self._score_rows_with_prefix_cache(
+                input_ids, labels_tokens, prefix_groups, label_scoring, top_k, answer_positions, answer_token_ids
+            )
+
+        input_enc = self._pad_rows(input_ids)
         for k, v in input_enc.items():
             input_enc[k] = v.to(self.model.device)
 
-        # Get model output logits
+        # Get the decoder's hidden states (the LM head only runs on the positions we score)
         with torch.no_grad():
-            model_output = self.model(**input_enc)
+            model_output = self.model.get_decoder()(**input_enc)
 
-        # Compute the log probabilities associated with each of the labels
-        labels_log_probs = F.log_softmax(model_output.logits, dim=-1)
+        # Rows end before their padding
+        row_ends = [len(ids) for ids in input_ids]
 
-        # Get the ids of the token before the last token before padding (to see the probablity of the last token given the one before the last token)
-        before_padding_ids = (
-            input_enc["input_ids"].ne(self.tokenizer.pad_token_id).sum(-1) - 2
-        )
+        scores = self._labels_log_probs(model_output.last_hidden_state, row_ends, labels_tokens, label_scoring)
+        if top_k or answer_token_ids is not None:
+            return (scores, *self._answer_log_probs(
+                model_output.last_hidden_state, answer_positions, prefix_groups, top_k, answer_token_ids
+            ))
+        return scores
+
+    def _pad_rows(self, input_ids, prefix_len=0):
+        """Right-pads token rows into a batch. The first prefix_len (cached) positions are always attended."""
+        max_len = max(len(ids) for ids in input_ids)
+        padded_ids = torch.full((len(input_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids), prefix_len + max_len), dtype=torch.long)
+        attention_mask[:, :prefix_len] = 1
+        for i, ids in enumerate(input_ids):
+            padded_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, prefix_len:prefix_len + len(ids)] = 1
+        return {"input_ids": padded_ids, "attention_mask": attention_mask}
+
+    def _lm_head(self, hidden_states):
+        """Float logits of the given hidden states."""
+        with torch.no_grad():
+            logits = self.model.get_output_embeddings()(hidden_states).float()
+        # Same final logit soft-capping as the model's own forward (Gemma 2 style models)
+        softcapping = getattr(self.model.config.get_text_config(), "final_logit_softcapping", None)
+        if softcapping is not None:
+            logits = torch.tanh(logits / softcapping) * softcapping
+        return logits
+
+    def _answer_log_probs(self, hidden_states, positions, prefix_groups, top_k=0, answer_token_ids=None):
+        """
+        Next-token log probabilities at positions[i] of every row, on CPU: the top-k ids (int32) and
+        log probabilities (float16) with top_k, then those of answer_token_ids[i] with answer_token_ids.
+        Rows of the same prefix group share their answer position, so it is only projected once per group.
+        """
+        if prefix_groups is None:
+            prefix_groups = list(range(len(positions)))
+        group_first_row = {}
+        for i, g in enumerate(prefix_groups):
+            group_first_row.setdefault(g, i)
+        first_rows = list(group_first_row.values())
+        device = hidden_states.device
+        logits = self._lm_head(hidden_states[
+            torch.tensor(first_rows, device=device), torch.tensor([positions[i] for i in first_rows], device=device)
+        ])
+        log_probs = torch.log_softmax(logits, dim=-1)
+        group_index = {g: k for k, g in enumerate(group_first_row)}
+        row_groups = torch.tensor([group_index[g] for g in prefix_groups])
+        outputs = ()
+        if top_k:
+            top = torch.topk(log_probs, top_k, dim=-1)
+            outputs += (top.indices.cpu()[row_groups].to(torch.int32), top.values.cpu()[row_groups].to(torch.float16))
+        if answer_token_ids is not None:
+            ids = torch.zeros((len(answer_token_ids), max(1, max(len(row_ids) for row_ids in answer_token_ids))),
+                              dtype=torch.long)
+            mask = torch.zeros(ids.shape, dtype=torch.bool)
+            for i, row_ids in enumerate(answer_token_ids):
+                ids[i, :len(row_ids)] = torch.tensor(row_ids, dtype=torch.long)
+                mask[i, :len(row_ids)] = True
+            token_log_probs = log_probs[row_groups.to(device)[:, None], ids.to(device)].cpu()
+            outputs += (token_log_probs.masked_fill(~mask, float("-inf")),)
+        return outputs
+
+    def _labels_log_probs(self, hidden_states, row_ends, labels_tokens, label_scoring="last_token"):
+        """
+        Log probability of the label tokens labels_tokens[i] ending row i at position row_ends[i].
+        The LM head runs only on the hidden states predicting a label token (one per label token of
+        every row, flattened across rows) instead of the whole (batch, length, vocab) logits, and each
+        label logit is normalized with a logsumexp over its own position. The token log probabilities
+        are then summed per row, or averaged with label_scoring="mean".
+        """
+        device = hidden_states.device
+        rows = torch.tensor([i for i, tokens in enumerate(labels_tokens) for _ in tokens], device=device)
+        # Label token j of a k-token label ending at `end` sits at end - k + j and is predicted one position earlier
+        positions = torch.tensor([
+            end - len(tokens) - 1 + j for end, tokens in zip(row_ends, labels_tokens) for j in range(len(tokens))
+        ], device=device)
+        targets = torch.tensor([token for tokens in labels_tokens for token in tokens], device=device)
+
+        logits = self._lm_head(hidden_states[rows, positions])
+        token_log_probs = logits[torch.arange(len(targets), device=device), targets] - torch.logsumexp(logits, dim=-1)
+
+        scores = torch.zeros(len(labels_tokens), device=device).index_add_(0, rows, token_log_probs)
+        if label_scoring == "mean":
+            scores = scores / torch.tensor([len(tokens) for tokens in labels_tokens], device=device)
+        return scores
+
+    def _score_rows_with_prefix_cache(self, input_ids, labels_tokens, prefix_groups=None, label_scoring="last_token",
+                                      top_k=0, answer_positions=None, answer_token_ids=None):
+        """
+        Same scores as the plain path, but shared tokens are encoded once and their
+        past_key_values are reused, in up to three levels:
+        1. the prefix common to all rows (system message, template head),
+        2. the rest of each group's shared prefix (rows of the same prompt, or the same pair),
+        3. the label suffix of every row.
+        prefix_groups gives a group id per row; by default all rows form a single group.
+        """
+        if prefix_groups is None:
+            prefix_groups = [0] * len(input_ids)
 
-        # Collect labels scores from the -2 token in labels_log_probs (the one that predict the last token)
-        # and collect for each line the id in labels_tokens
-        labels_scores = labels_log_probs[:, before_padding_ids, labels_tokens]
+        def common_prefix_len(rows):
+            # Keep the label tokens of every row and the token before them out of the prefix,
+            # so all the positions predicting a label token are part of the suffix
+            # (and the answer position as well when it is captured).
+            length = 0
+            for tokens in zip(*(input_ids[i] for i in rows)):
+                if any(t != tokens[0] for t in tokens):
+                    break
+                length += 1
+            length = min(length, min(len(input_ids[i]) - len(labels_tokens[i]) - 1 for i in rows))
+            if top_k or answer_token_ids is not None:
+                length = min(length, min(answer_positions[i] for i in rows))
+            return length
 
-        # Need just the diagonal of the matrix, as it the prob of the label for each line
-        labels_scores = torch.diag(labels_scores)
+        prefix_len = common_prefix_len(range(len(input_ids)))
+        groups = list(dict.fromkeys(prefix_groups))
+        group_rows = {g: [i for i, row_g in enumerate(prefix_groups) if row_g == g] for g in groups}
+        group_ends = {g: common_prefix_len(rows) for g, rows in group_rows.items()}
+        if prefix_len < 0 or min(group_ends.values()) <= 0:
+            # Nothing to share (e.g. a single-token prompt), fall back to a full pass
+            return self.score_rows(
+                input_ids, labels_tokens, prefix_groups=prefix_groups, label_scoring=label_scoring,
+                top_k=top_k, answer_positions=answer_positions, answer_token_ids=answer_token_ids,
+            )
+        sliding_window = getattr(self.model.config.get_text_config(), "sliding_window", None)
+        if sliding_window is not None and max(len(ids) for ids in input_ids) > sliding_window:
+            # Sliding-window layers only keep the last window of the cache, which the
+            # padded cache layout below does not account for
+            return self.score_rows(
+                input_ids, labels_tokens, prefix_groups=prefix_groups, label_scoring=label_scoring,
+                top_k=top_k, answer_positions=answer_positions, answer_token_ids=answer_token_ids,
+            )
 
-        # metadata = {
-        #     'input_ids': input_enc.input_ids,
-        #     'logits': model_output.logits,
-        # }
+        # The prefix passes only fill the cache, so they skip the LM head entirely
+        device = self.model.device
+        decoder = self.model.get_decoder()
+        if prefix_len > 0:
+            prefix_ids = torch.tensor([input_ids[0][:prefix_len]], device=device)
+            with torch.no_grad():
+                prefix_output = decoder(input_ids=prefix_ids, use_cache=True)
+            past_key_values = prefix_output.past_key_values
+        else:
+            # Groups share no first token (e.g. raw prompts without a BOS token): level 2 starts the cache
+            past_key_values = None
+
+        # Level 2: encode the remainder of every group prefix once, on top of the shared prefix.
+        # Padding sits in the middle of the cache from here on, so positions are passed explicitly.
+        remainders = [input_ids[group_rows[g][0]][prefix_len:group_ends[g]] for g in groups]
+        remainder_len = max(len(r) for r in remainders)
+        if remainder_len > 0:
+            if past_key_values is not None:
+                past_key_values.batch_select_indices(torch.zeros(len(groups), dtype=torch.long))
+            remainder_enc = self._pad_rows(remainders, prefix_len=prefix_len)
+            position_ids = prefix_len + torch.arange(remainder_len).repeat(len(groups), 1)
+            with torch.no_grad():
+                past_key_values = decoder(
+                    input_ids=remainder_enc["input_ids"].to(device),
+                    attention_mask=remainder_enc["attention_mask"].to(device),
+                    position_ids=position_ids.to(device),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                ).past_key_values
+            cached_mask = remainder_enc["attention_mask"]
+            row_groups = torch.tensor([groups.index(g) for g in prefix_groups])
+        else:
+            cached_mask = torch.ones((1, prefix_len), dtype=torch.long)
+            row_groups = torch.zeros(len(input_ids), dtype=torch.long)
+
+        # Level 3: expand the cache to the rows and run only the label suffixes
+        past_key_values.batch_select_indices(row_groups)
+        suffixes = [ids[group_ends[g]:] for ids, g in zip(input_ids, prefix_groups)]
+        suffix_enc = self._pad_rows(suffixes)
+        attention_mask = torch.cat([cached_mask[row_groups], suffix_enc["attention_mask"]], dim=1)
+        suffix_len = suffix_enc["input_ids"].shape[1]
+        position_ids = torch.tensor([group_ends[g] for g in prefix_groups])[:, None] + torch.arange(suffix_len)
+
+        with torch.no_grad():
+            model_output = decoder(
+                input_ids=suffix_enc["input_ids"].to(device),
+                attention_mask=attention_mask.to(device),
+                position_ids=position_ids.to(device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+
+        # Rows end (inside the suffix) before their padding
+        suffix_ends = [len(s) for s in suffixes]
 
-        return labels_scores #, metadata
+        scores = self._labels_log_probs(model_output.last_hidden_state, suffix_ends, labels_tokens, label_scoring)
+        if top_k or answer_token_ids is not None:
+            # Answer positions inside the suffixes
+            suffix_positions = [position - group_ends[g] for position, g in zip(answer_positions, prefix_groups)]
+            return (scores, *self._answer_log_probs(
+                model_output.last_hidden_state, suffix_positions, prefix_groups, top_k, answer_token_ids
+            ))
+        return scores
 
 qwen2_5_sizes = ['0.5', '7', '32', '72']
 gemma3_sizes = ['1', '4', '12', '27']
 
-def load_qwen2_5_agent(model_size: float):
+def qwen2_5_model_id(model_size: float):
     assert model_size in qwen2_5_sizes, f"Model size must be one of {qwen2_5_sizes}"
-    
-    model_id = f"Qwen/Qwen2.5-{model_size}B-instruct"
-
-    return InstructedHFAgent(model_id)
+    return f"Qwen/Qwen2.5-{model_size}B-instruct"
 
-def load_gemma3_agent(model_size: float):
+def gemma3_model_id(model_size: float):
     assert model_size in gemma3_sizes, f"Model size must be one of {gemma3_sizes}"
+    return f"google/gemma-3-{model_size}b-it"
+
+def load_qwen2_5_agent(model_size: float, device_map="auto"):
+    model_id = qwen2_5_model_id(model_size)
+
+    return InstructedHFAgent(model_id, device_map=device_map)
+
+def load_gemma3_agent(model_size: float, device_map="auto"):
+    model_id = gemma3_model_id(model_size)
     
-    model_id = f"google/gemma-3-{model_size}b-it"
-    
-    return InstructedHFAgent(model_id)
+    return InstructedHFAgent(model_id, device_map=device_map)
@@ -1,15 +1,23 @@
 import pandas as pd
 import numpy as np
 import os
-from src.pref_models import fit_bradley_terry
+from concurrent.futures import ProcessPoolExecutor
+from src.pref_models import bootstrap_bradley_terry, build_methods_template_wins, fit_bt_convergence
+from src.catalog import experiment_dirs
+from src.scores_io import read_scores, scores_path
 
-def analyze_bt_convergence(exp_name):
-    scores_path = f"experiments/{exp_name}/scores.csv"
-    if not os.path.exists(scores_path):
-        print(f"File not found: {scores_path}")
+def analyze_bt_convergence(exp_name, n_jobs=1):
+    """
+    BT convergence curves of all scoring methods of an experiment, saved to bt_convergence.csv.
+    The per-template wins of every method are built in a single pass over the scores, and the
+    methods' curves are fitted in a process pool when n_jobs > 1.
+    """
+    exp_dir = f"experiments/{exp_name}"
+    if scores_path(exp_dir) is None:
+        print(f"No scores file found in {exp_dir}")
         return
 
-    df_scores = pd.read_csv(scores_path)
+    df_scores = read_scores(exp_dir)
 
     # In case the file is empty or malformed
     if df_scores.empty:
@@ -26,41 +34,44 @@ def analyze_bt_convergence(exp_name):
     # Get all unique items from the dataset
     items = np.unique(np.concatenate([df_scores['item_a'].unique(), df_scores['item_b'].unique()]))
 
-    all_results = []
+    # Determine winners (Higher score wins, ties go to item_a as before) of all methods at once
+    methods_wins = build_methods_template_wins(
+        df_scores, items, templates, [(col_a, col_b) for _, col_a, col_b in methods]
+    )
 
-    for method_name, col_a, col_b in methods:
-        print(f"Processing method: {method_name}")
-        for i in range(1, len(templates) + 1):
-            # Select templates 0 to i-1
-            current_templates = templates[:i]
-            
-            # Filter data
-            df_subset = df_scores[df_scores['template'].isin(current_templates)].copy()
-            
-            # Determine winner (Higher score wins)
-            # Handle potential tie or same scores? Usually > is fine, or >=. Previous code used >=.
-            df_subset['winner'] = np.where(df_subset[col_a] >= df_subset[col_b], df_subset['item_a'], df_subset['item_b'])
-            
-            # Fit BT
-            ranking, _ = fit_bradley_terry(df_subset, items)
-            
-            # Collect results
-            for _, row in ranking.iterrows():
-                all_results.append({
-                    'method': method_name,
-                    'iteration': i,
-                    'num_templates': i,
-                    'item': row['Color'],
-                    'score': row['BT_Score']
-                })
+    # Fit BT on templates 0 to i-1 for every i, incrementally
+    print(f"Processing methods: {', '.join(name for name, _, _ in methods)}")
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            histories = list(pool.map(fit_bt_convergence, methods_wins))
+    else:
+        histories = [fit_bt_convergence(method_wins) for method_wins in methods_wins]
+
+    # Collect results: one row per (method, iteration, item)
+    n_templates, n_items = len(templates), len(items)
+    iterations = np.tile(np.repeat(np.arange(1, n_templates + 1), n_items), len(methods))
+    df_results = pd.DataFrame({
+        'method': np.repeat([name for name, _, _ in methods], n_templates * n_items),
+        'iteration': iterations,
+        'num_templates': iterations,
+        'item': np.tile(items, len(methods) * n_templates),
+        'score': np.concatenate([history.ravel() for history in histories]),
+    })
 
-    df_results = pd.DataFrame(all_results)
     output_path = f"experiments/{exp_name}/bt_convergence.csv"
     df_results.to_csv(output_path, index=False)
     print(f"Saved results to {output_path}")
     
     return df_results
 
+def analyze_many_bt_convergence(exp_names, n_jobs=None):
+    """
+    Runs analyze_bt_convergence for many experiments in a process pool.
+    Returns a dict mapping each experiment name to its convergence DataFrame.
+    """
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        return dict(zip(exp_names, pool.map(analyze_bt_convergence, exp_names)))
+
 def load_experiment_rankings(exp_name):
     """
     Loads all method rankings from an experiment folder into a single DataFrame.
@@ -82,3 +93,37 @@ def load_experiment_rankings(exp_name):
         
     return pd.concat(dfs, ignore_index=True)
 
+def _bootstrap_scores_file(exp_dir, kwargs):
+    df = read_scores(exp_dir)
+    # data/ folders (collect_data) name the items option_a / option_b
+    df = df.rename(columns={'option_a': 'item_a', 'option_b': 'item_b'})
+    if 'score_a' not in df.columns:
+        # Method scores only (collect_data with methods)
+        print(f"Warning: no score_a / score_b columns in {exp_dir}")
+        return None
+    df = df.dropna(subset=['score_a', 'score_b'])
+    if df.empty:
+        print(f"Warning: no valid scores in {exp_dir}")
+        return None
+    df['winner'] = np.where(df['score_a'] >= df['score_b'], df['item_a'], df['item_b'])
+    items = sorted(set(df['item_a']) | set(df['item_b']))
+    return bootstrap_bradley_terry(df, items, **kwargs)
+
+def bootstrap_experiments(base_folder="data", n_jobs=None, **kwargs):
+    """
+    Bootstrap BT confidence intervals (see pref_models.bootstrap_bradley_terry) for every experiment
+    folder with a scores file (parquet or csv) under base_folder, one experiment per worker process.
+    kwargs are passed to bootstrap_bradley_terry (unit, n_boot, alpha, soft, solver, seed, prior).
+    Returns a single DataFrame with an 'experiment' column (the folder path relative to base_folder).
+    """
+    exp_dirs = experiment_dirs(base_folder)
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(pool.map(_bootstrap_scores_file, exp_dirs, [kwargs] * len(exp_dirs)))
+
+    dfs = [
+        df.assign(experiment=os.path.relpath(exp_dir, base_folder))
+        for exp_dir, df in zip(exp_dirs, results) if df is not None
+    ]
+    if not dfs:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
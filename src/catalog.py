@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import sqlite3
+import pandas as pd
+
+from datetime import datetime
+from src.scores_io import SCORES_CSV, SCORES_PARQUET, read_scores, scores_path
+
+CATALOG_PATH = os.path.join("data", "catalog.sqlite")
+# collect_data runs live in data/, directly or in subfolders (gemma, new_prompts, prev_prompts, ...)
+EXPERIMENT_FOLDERS = ["data", "experiments"]
+
+# collect_data folders: {family}-{size}-{alternatives}-{YYYYmmdd_HHMMSS}
+DATA_NAME_RE = re.compile(r"^(?P<family>[a-z]+)-(?P<size>[\d.]+)-(?P<alternatives>[^-]+)-(?P<timestamp>\d{8}_\d{6})$")
+# run_experiment model aliases: qwen7I, gemma1, qwen0_5, ...
+MODEL_ALIAS_RE = re.compile(r"^(?P<family>[a-zA-Z]+)(?P<size>\d+(?:_\d+)?)(?P<instruct>I?)$")
+TIMESTAMP_RE = re.compile(r"\d{8}_\d{6}")
+# Template shards of a sharded run (run_work_queue), merged into their parent folder when complete
+SHARD_DIR_RE = re.compile(r"^shard-\d+$")
+
+# (method, score column of item_a, score column of item_b) of the known scores layouts
+SCORE_METHODS = [
+    ('last_token', 'score_a', 'score_b'),
+    ('single', 'score_single_a', 'score_single_b'),
+    ('group', 'score_group_a', 'score_group_b'),
+    ('ppl', 'score_ppl_a', 'score_ppl_b'),
+]
+
+EXPERIMENT_COLUMNS = ['experiment', 'source', 'family', 'size', 'instruct', 'alternatives', 'timestamp', 'n_rows']
+
+
+def parse_experiment_folder(exp_dir):
+    """Model family / size, alternatives set and timestamp of an experiment folder, from its name and config.json."""
+    name = os.path.basename(os.path.normpath(exp_dir))
+    info = {'family': None, 'size': None, 'instruct': None, 'alternatives': None, 'timestamp': None}
+    match = DATA_NAME_RE.match(name)
+    if match:
+        info.update(match.groupdict())
+        # collect_data only loads instruct models (Qwen2.5-...-instruct, gemma-3-...-it)
+        info['instruct'] = True
+    config_path = os.path.join(exp_dir, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            config = json.load(f)
+        info['alternatives'] = config.get('alternatives', info['alternatives'])
+        match = MODEL_ALIAS_RE.match(str(config.get('model_name', '')))
+        if match:
+            info['family'] = match['family']
+            info['size'] = match['size'].replace('_', '.')
+            info['instruct'] = bool(match['instruct'])
+    if info['timestamp'] is None:
+        match = TIMESTAMP_RE.search(name)
+        info['timestamp'] = match.group() if match else None
+    if info['timestamp'] is not None:
+        info['timestamp'] = datetime.strptime(info['timestamp'], "%Y%m%d_%H%M%S").isoformat(sep=' ')
+    return info
+
+
+def experiment_dirs(base_folder):
+    """Sorted folders with a scores file under base_folder, without the template shards of sharded runs."""
+    exp_dirs = []
+    for root, dirs, files in os.walk(base_folder):
+        dirs[:] = [d for d in dirs if not SHARD_DIR_RE.match(d)]
+        if SCORES_PARQUET in files or SCORES_CSV in files:
+            exp_dirs.append(root)
+    return sorted(exp_dirs)
+
+
+class ExperimentCatalog:
+    """
+    Single SQLite index of the scores of all experiment folders.
+
+    Every folder with a scores file is ingested once (and again only when its scores file changes),
+    with its model family / size, alternatives set and timestamp. Scores are stored in long format,
+    one row per (experiment, template, pair, scoring method), with template and item texts interned
+    in a separate table. query() then returns the scores of many experiments as one DataFrame.
+    """
+
+    def __init__(self, path=CATALOG_PATH, timeout=120):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=timeout)
+        with self._conn as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS experiments (
+                    experiment TEXT PRIMARY KEY, source TEXT, family TEXT, size TEXT, instruct INTEGER,
+                    alternatives TEXT, timestamp TEXT, n_rows INTEGER, scores_file TEXT, scores_mtime REAL);
+                CREATE TABLE IF NOT EXISTS texts (id INTEGER PRIMARY KEY, text TEXT UNIQUE NOT NULL);
+                CREATE TABLE IF NOT EXISTS scores (
+                    experiment TEXT NOT NULL, method TEXT NOT NULL,
+                    template INTEGER NOT NULL, item_a INTEGER NOT NULL, item_b INTEGER NOT NULL,
+                    score_a REAL, score_b REAL);
+                CREATE INDEX IF NOT EXISTS scores_experiment ON scores (experiment, method);
+            """)
+
+    def _text_ids(self, conn, texts):
+        texts = list(dict.fromkeys(texts))
+        conn.executemany("INSERT OR IGNORE INTO texts (text) VALUES (?)", [(text,) for text in texts])
+        ids = {}
+        for start in range(0, len(texts), 500):
+            chunk = texts[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            ids.update(conn.execute(f"SELECT text, id FROM texts WHERE text IN ({placeholders})", chunk).fetchall())
+        return ids
+
+    def ingest(self, exp_dir, force=False):
+        """Adds (or refreshes) the scores of an experiment folder. Returns False if it was already up to date."""
+        path = scores_path(exp_dir)
+        if path is None:
+            return False
+        experiment = os.path.relpath(exp_dir)
+        mtime = os.path.getmtime(path)
+        row = self._conn.execute(
+            "SELECT scores_file, scores_mtime FROM experiments WHERE experiment = ?", (experiment,)
+        ).fetchone()
+        if row == (os.path.basename(path), mtime) and not force:
+            return False
+
+        df = read_scores(exp_dir)
+        # data/ folders (collect_data) name the items option_a / option_b
+        df = df.rename(columns={'option_a': 'item_a', 'option_b': 'item_b'})
+        info = parse_experiment_folder(exp_dir)
+        with self._conn as conn:
+            conn.execute("DELETE FROM scores WHERE experiment = ?", (experiment,))
+            ids = self._text_ids(conn, pd.concat([df['template'], df['item_a'], df['item_b']]).astype(str))
+            template, item_a, item_b = (df[col].astype(str).map(ids).tolist() for col in ('template', 'item_a', 'item_b'))
+            for method, col_a, col_b in SCORE_METHODS:
+                if col_a not in df.columns or col_b not in df.columns:
+                    continue
+                scores_a = df[col_a].astype(float).tolist()
+                scores_b = df[col_b].astype(float).tolist()
+                conn.executemany(
+                    "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    zip([experiment] * len(df), [method] * len(df), template, item_a, item_b, scores_a, scores_b),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (experiment, os.path.basename(os.path.dirname(os.path.normpath(exp_dir))), info['family'], info['size'],
+                 info['instruct'], info['alternatives'], info['timestamp'], len(df), os.path.basename(path), mtime),
+            )
+        return True
+
+    def refresh(self, base_folders=EXPERIMENT_FOLDERS, force=False):
+        """Ingests every new or changed experiment folder under base_folders and drops the deleted ones."""
+        n_ingested = 0
+        seen = set()
+        for base_folder in base_folders:
+            if not os.path.isdir(base_folder):
+                continue
+            for exp_dir in experiment_dirs(base_folder):
+                seen.add(os.path.relpath(exp_dir))
+                n_ingested += self.ingest(exp_dir, force=force)
+        # Experiments under the refreshed folders whose scores file is gone
+        roots = tuple(os.path.relpath(folder) + os.sep for folder in base_folders)
+        stale = [
+            experiment for (experiment,) in self._conn.execute("SELECT experiment FROM experiments")
+            if experiment.startswith(roots) and experiment not in seen
+        ]
+        with self._conn as conn:
+            for experiment in stale:
+                conn.execute("DELETE FROM scores WHERE experiment = ?", (experiment,))
+                conn.execute("DELETE FROM experiments WHERE experiment = ?", (experiment,))
+        print(f"Catalog: {n_ingested} experiments ingested, {len(stale)} removed, {len(self)} in total")
+        return n_ingested
+
+    @staticmethod
+    def _filters(family=None, size=None, alternatives=None, source=None, since=None, until=None, experiment=None):
+        """SQL conditions on the experiments table. Filters accept a single value or a list of values."""
+        conditions, params = [], []
+        for column, value in [('family', family), ('size', size), ('alternatives', alternatives),
+                              ('source', source), ('experiment', experiment)]:
+            if value is None:
+                continue
+            values = [str(v) for v in value] if isinstance(value, (list, tuple, set)) else [str(value)]
+            conditions.append(f"e.{column} IN ({','.join('?' * len(values))})")
+            params += values
+        if since is not None:
+            conditions.append("e.timestamp >= ?")
+            params.append(str(since))
+        if until is not None:
+            conditions.append("e.timestamp <= ?")
+            params.append(str(until))
+        return conditions, params
+
+    def experiments(self, **filters):
+        """The experiments matching the filters (see query), one row each."""
+        conditions, params = self._filters(**filters)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        df = pd.read_sql_query(
+            f"SELECT {', '.join('e.' + c for c in EXPERIMENT_COLUMNS)} FROM experiments e {where} ORDER BY e.experiment",
+            self._conn, params=params,
+        )
+        df['instruct'] = df['instruct'].astype('boolean')
+        return df
+
+    def query(self, method=None, **filters):
+        """
+        Scores of all the experiments matching the filters, as a single DataFrame with the experiment
+        metadata columns followed by method, template, item_a, item_b, score_a and score_b.
+        Filters: family, size, alternatives, source, experiment (a value or a list of values),
+        since / until (timestamps, e.g. '2026-05-12' or '2026-05-12 16:00:00'), method ('last_token' for
+        data/ folders; 'single', 'group' or 'ppl' for run_experiment folders with several methods).
+        """
+        conditions, params = self._filters(**filters)
+        if method is not None:
+            methods = list(method) if isinstance(method, (list, tuple, set)) else [method]
+            conditions.append(f"s.method IN ({','.join('?' * len(methods))})")
+            params += methods
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        df = pd.read_sql_query(
+            f"""
+            SELECT {', '.join('e.' + c for c in EXPERIMENT_COLUMNS if c != 'n_rows')}, s.method,
+                   t.text AS template, a.text AS item_a, b.text AS item_b, s.score_a, s.score_b
+            FROM scores s
+            JOIN experiments e ON e.experiment = s.experiment
+            JOIN texts t ON t.id = s.template
+            JOIN texts a ON a.id = s.item_a
+            JOIN texts b ON b.id = s.item_b
+            {where}
+            ORDER BY s.rowid
+            """,
+            self._conn, params=params,
+        )
+        df['instruct'] = df['instruct'].astype('boolean')
+        for col in ['experiment', 'source', 'family', 'size', 'alternatives', 'method', 'template', 'item_a', 'item_b']:
+            df[col] = df[col].astype('category')
+        return df
+
+    def __len__(self):
+        (n_experiments,) = self._conn.execute("SELECT COUNT(*) FROM experiments").fetchone()
+        return n_experiments
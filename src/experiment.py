@@ -1,35 +1,55 @@
 import itertools
+import numpy as np
 import pandas as pd
 from typing import List
-from pref_models import fit_bradley_terry
+from pref_models import build_wins_matrix, fit_bt_wins
 from tqdm import tqdm
 
 from src.agent import Agent
+from src.scores_io import ScoresLog, write_scores
 
-def query_for_single_template(agent, alternatives, template):
+def query_for_single_template(agent, alternatives, template, label_scoring="last_token"):
     results = []
     for a1, a2 in itertools.permutations(alternatives, 2):
         prompt = template.format(A=a1, B=a2)
-        scores = agent.query(prompt, [a1, a2])
+        scores = agent.query(prompt, [a1, a2], label_scoring=label_scoring)
         # Store or process scores as needed
         results.append({
             "template": template,
             "item_a": a1,
             "item_b": a2,
-            "score_a": scores[0],
-            "score_b": scores[1]
+            "score_a": float(scores[0]),
+            "score_b": float(scores[1])
         })
     return pd.DataFrame(results)
 
-def query_all(agent, alternatives, task_prompt):
-    scores = agent.query(task_prompt, alternatives)
+def score_matrix(scores):
+    """n x n matrix of score differences between alternatives: matrix[i, j] = scores[i] - scores[j]."""
+    scores = np.asarray(scores, dtype=float)
+    return scores[:, None] - scores[None, :]
+
+def query_list(agent, alternatives, task_prompt, label_scoring="last_token"):
+    """
+    Scores every alternative as a continuation of a single task prompt, in one batched forward pass
+    sharing the prompt's prefix cache. Returns the scores of the alternatives and their n x n
+    score-difference matrix.
+    """
+    scores = agent.query(task_prompt, alternatives, use_prefix_cache=True, label_scoring=label_scoring)
+    scores = scores.float().cpu().numpy()
+    return scores, score_matrix(scores)
+
+def query_all(agent, alternatives, task_prompt, label_scoring="last_token"):
+    scores, _ = query_list(agent, alternatives, task_prompt, label_scoring)
+    # Upper triangle, in the same order as itertools.combinations
+    idx_a, idx_b = np.triu_indices(len(alternatives), k=1)
+    items = np.asarray(alternatives, dtype=object)
     return pd.DataFrame({
         "template": task_prompt,
-        "item_a": alternatives[i],
-        "item_b": alternatives[j],
-        "score_a": scores[i],
-        "score_b": scores[j]  
-    } for i, j in itertools.combinations(range(len(alternatives)), 2))
+        "item_a": items[idx_a],
+        "item_b": items[idx_b],
+        "score_a": scores[idx_a].astype(float),
+        "score_b": scores[idx_b].astype(float),
+    })
 
 def run_experiment(
     agent: Agent,
@@ -37,30 +57,44 @@ def run_experiment(
     templates: List[str],
     exp_name: str, #TODO: change to logger
     pairwise: bool = True,
+    label_scoring: str = "last_token",
 ):        
-    pref_data = pd.DataFrame()
-    pref_weights = pd.DataFrame()
+    exp_dir = f"experiments/{exp_name}"
+    # Every finished template (its scores and the BT fit after it) is one chunk of a crash-safe log,
+    # so an interrupted run restarted with the same exp_name skips the templates it already did
+    scores_log = ScoresLog(exp_dir)
+    logged = {chunk["iteration"]: chunk for chunk in scores_log.read()}
+    pref_data, pref_weights = [], []
+    # Running wins matrix and the last fit, so every iteration only adds the new template's data
+    wins = np.zeros((len(alternatives), len(alternatives)))
+    betas = None
     for i, template in tqdm(enumerate(templates)): #TODO: add template generator
-        # TODO: log for Wandb?
-        # 1. Collect new data
-        if pairwise:
-            current_data = query_for_single_template(agent, alternatives, template)
+        if i in logged:
+            current_data = pd.DataFrame(logged[i]["scores"])
+            wins += build_wins_matrix(current_data, alternatives)
+            betas = np.array(logged[i]["weights"])
         else:
-            current_data = query_all(agent, alternatives, template)
-        current_data['winner'] = current_data.apply(lambda row: row['item_a'] if row['score_a'] > row['score_b'] else row['item_b'], axis=1)
-        pref_data = pd.concat([pref_data, current_data.assign(iteration=i)], ignore_index=True)
-        
-        # 2. Fit new BT model
-        # ranking is a dataframe with columns 'Color" and 'BT_Score'
-        ranking, _ = fit_bradley_terry(pref_data, alternatives)
-        pref_weights = pd.concat([pref_weights, ranking.assign(iteration=i)], ignore_index=True)
-        
-        pref_data.to_csv(f"experiments/{exp_name}/scores.csv", index=False)
-        pref_weights.to_csv(f"experiments/{exp_name}/BT_weights.csv", index=False)
-    
-    # # TODO: log this
-    # pref_data.to_csv(f"experiments/{exp_name}/scores.csv", index=False)
-    # pref_weights.to_csv(f"experiments/{exp_name}/BT_weights.csv", index=False)
+            # TODO: log for Wandb?
+            # 1. Collect new data
+            if pairwise:
+                current_data = query_for_single_template(agent, alternatives, template, label_scoring)
+            else:
+                current_data = query_all(agent, alternatives, template, label_scoring)
+            current_data['winner'] = np.where(current_data['score_a'] > current_data['score_b'], current_data['item_a'], current_data['item_b'])
+
+            # 2. Fit new BT model, warm-started from the previous iteration
+            wins += build_wins_matrix(current_data, alternatives)
+            betas = fit_bt_wins(wins, initial_betas=betas)
+            scores_log.append({"iteration": i, "scores": current_data.to_dict("records"), "weights": betas.tolist()})
+
+        # ranking is a dataframe with columns 'Item' and 'BT_Score'
+        ranking = pd.DataFrame({'Item': alternatives, 'BT_Score': betas})
+        pref_data.append(current_data.assign(iteration=i))
+        pref_weights.append(ranking.assign(iteration=i))
+
+    write_scores(pd.concat(pref_data, ignore_index=True), exp_dir)
+    pd.concat(pref_weights, ignore_index=True).to_csv(f"{exp_dir}/BT_weights.csv", index=False)
+    scores_log.close(remove=True)
     
     print("Experiment complete.")
     print("Final Weights:")
@@ -1,6 +1,9 @@
 import torch
 import torch.nn.functional as F
+from functools import lru_cache
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from src.agent import InstructedHFAgent
+from src.scheduler import pack_batches
 
 
 def load_model(model_id="Qwen/Qwen2.5-0.5B"):
@@ -53,54 +56,40 @@ def get_top_k_tokens(model, tokenizer, prompt_text, k=5):
     top_tokens = [tokenizer.decode([idx]) for idx in top_indices]
     return top_tokens
 
+# The cache is bounded: it is keyed on the tokenizer object and would otherwise keep every
+# tokenizer of a long-lived process alive
+@lru_cache(maxsize=4096)
+def _variant_token_ids(tokenizer, text):
+    """Single-token IDs of text, capitalized and with a leading space (tokenized once per tokenizer)."""
+    valid_ids = set()
+    for cand in {text, " " + text, text.capitalize(), " " + text.capitalize()}:
+        # add_special_tokens=False is crucial
+        ids = tokenizer.encode(cand, add_special_tokens=False)
+        if len(ids) == 1:
+            valid_ids.add(ids[0])
+    return frozenset(valid_ids)
+
+def get_candidate_token_ids(tokenizer, option, alias):
+    """
+    Token IDs of the valid single-token answers for an option: the option itself, capitalized,
+    with a leading space, and its fixed alias ('A' or 'B' in our prompts).
+    Multi-token candidates are ignored for "next token" probability.
+    """
+    return sorted(_variant_token_ids(tokenizer, option) | _variant_token_ids(tokenizer, alias))
+
 def get_scores_many_options(model, tokenizer, prompt_text, option_a, option_b):
     """
     Determines the winner by comparing the cumulative probability of valid tokens
     for option_a vs option_b.
     Valid tokens for option 'red': ['red', ' red', 'Red', ' Red', 'A', ' A'] (and similarly for B)
+    Many prompts are scored in batches by get_method_scores_batch (its score_group_* values).
     """
     # Encode the prompt
     inputs = tokenizer(prompt_text, return_tensors="pt").to(model.device)
 
-    # 1. Define candidate strings for each option
-    # Note: 'A' and 'B' are fixed aliases for option_a and option_b respectively in our prompts
-    candidates_a = [
-        option_a, 
-        " " + option_a, 
-        option_a.capitalize(), 
-        " " + option_a.capitalize(),
-        "A", 
-        " A"
-    ]
-    candidates_b = [
-        option_b, 
-        " " + option_b, 
-        option_b.capitalize(), 
-        " " + option_b.capitalize(),
-        "B", 
-        " B"
-    ]
-    
-    # Remove duplicates
-    candidates_a = list(set(candidates_a))
-    candidates_b = list(set(candidates_b))
-
-    # 2. Get token IDs for all valid candidates
-    # We only care about single-token candidates. Multi-token ones are ignored for "next token" probability.
-    
-    def get_valid_token_ids(candidates):
-        valid_ids = []
-        for cand in candidates:
-            # add_special_tokens=False is crucial
-            ids = tokenizer.encode(cand, add_special_tokens=False)
-            if len(ids) == 1:
-                valid_ids.append(ids[0])
-            else:
-                pass 
-        return list(set(valid_ids))
-
-    ids_a_list = get_valid_token_ids(candidates_a)
-    ids_b_list = get_valid_token_ids(candidates_b)
+    # 1-2. Token IDs of the single-token candidates of each option
+    ids_a_list = get_candidate_token_ids(tokenizer, option_a, "A")
+    ids_b_list = get_candidate_token_ids(tokenizer, option_b, "B")
     
     # 3. Get logits and Probabilities
     with torch.no_grad():
@@ -113,53 +102,106 @@ def get_scores_many_options(model, tokenizer, prompt_text, option_a, option_b):
     probs = torch.nn.functional.softmax(next_token_logits, dim=-1)
     
     # 4. Sum probabilities
-    prob_a = sum(probs[idx].item() for idx in ids_a_list)
-    prob_b = sum(probs[idx].item() for idx in ids_b_list)
+    prob_a = probs[ids_a_list].sum().item()
+    prob_b = probs[ids_b_list].sum().item()
     
     return prob_a, prob_b
 
 
-def get_perplexity_scores(model, tokenizer, prompt, choice_a, choice_b):
+def _option_rows(tokenizer, prompt, options):
     """
-    Determines winner by prefilling the answer and checking which one 
-    has lower perplexity (higher likelihood).
-    """
-    options = [choice_a, choice_b]
-    scores = []
-
-    for option in options:
-        # 1. Prepare Full Text
-        # Note: Add a leading space if your prompt ends without one
-        full_text = prompt + " " + option 
-        
-        # 2. Tokenize
-        inputs = tokenizer(full_text, return_tensors="pt").to(model.device)
-        input_ids = inputs.input_ids
-        
-        # 3. Identify where the "Option" part starts
-        # We only want to score the option tokens, not the prompt tokens
-        prompt_len = len(tokenizer.encode(prompt, add_special_tokens=False))
-        
-        # 4. Forward Pass (No Generation!)
-        with torch.no_grad():
-            outputs = model(**inputs)
-            logits = outputs.logits
-
-        # 5. Calculate Loss for the Option tokens only
-        # Shift logits and labels so we predict the next token
-        shift_logits = logits[..., prompt_len-1:-1, :].contiguous()
-        shift_labels = input_ids[..., prompt_len:].contiguous()
-        
-        # Cross Entropy Loss (Average negative log likelihood)
-        loss = F.cross_entropy(
-            shift_logits.view(-1, shift_logits.size(-1)), 
-            shift_labels.view(-1),
-            reduction='none'
+    Token IDs of prompt + " " + option for every option, and where the option tokens start in each row:
+    after the prompt tokens, or after the part of them the row keeps if the option merges with the prompt.
+    """
+    prompt_ids = tokenizer(prompt)["input_ids"]
+    rows = [tokenizer(prompt + " " + option)["input_ids"] for option in options]
+    starts = []
+    for row in rows:
+        start = 0
+        while start < min(len(prompt_ids), len(row) - 1) and row[start] == prompt_ids[start]:
+            start += 1
+        starts.append(max(start, 1))
+    return rows, starts
+
+def get_perplexity_scores_batch(model, tokenizer, jobs, max_batch_tokens=4096, use_prefix_cache=True,
+                                answer_token_ids=None, on_batch=None):
+    """
+    Perplexity scores of many (prompt, options) jobs, e.g. a full template sweep, in a few batches.
+    Jobs are packed into batches of up to max_batch_tokens padded tokens; in every batch each prompt
+    is encoded once into a KV cache and all its option continuations (of any length) are evaluated
+    together on top of it (see InstructedHFAgent.score_rows).
+    Returns, for every job, a dict with the mean and summed NLL of each option's tokens.
+    With answer_token_ids (for every job, a list of token ids per option), the dict also has the
+    answer_log_probs of those ids at the answer position (the last prompt token), one tensor per
+    option, read from the same forward pass; the prompt only gets a row of its own if an option
+    changes its tokens.
+    on_batch(batch, results) runs after every batch with the indices of its jobs (see src.scheduler.score_jobs).
+    """
+    agent = InstructedHFAgent.with_model(model, tokenizer)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    encoded = []
+    for job_idx, (prompt, options) in enumerate(jobs):
+        rows, starts = _option_rows(tokenizer, prompt, options)
+        labels_tokens = [row[start:] for row, start in zip(rows, starts)]
+        prompt_ids = tokenizer(prompt)["input_ids"]
+        answer_ids = None
+        if answer_token_ids is not None:
+            answer_ids = list(answer_token_ids[job_idx])
+            if not all(row[:len(prompt_ids)] == prompt_ids for row in rows):
+                # The answer position is read from the first row of the job, so the prompt row goes first
+                rows, labels_tokens, answer_ids = [prompt_ids, *rows], [prompt_ids[-1:], *labels_tokens], [[], *answer_ids]
+        encoded.append((rows, labels_tokens, answer_ids, len(prompt_ids) - 1))
+    batches = pack_batches(
+        [max(len(row) for row in rows) for rows, *_ in encoded],
+        [len(rows) for rows, *_ in encoded],
+        max_batch_tokens,
+    )
+
+    results = [None] * len(jobs)
+    for batch in batches:
+        rows = [row for job_idx in batch for row in encoded[job_idx][0]]
+        labels_tokens = [tokens for job_idx in batch for tokens in encoded[job_idx][1]]
+        answer_kwargs = {}
+        if answer_token_ids is not None:
+            answer_kwargs = dict(
+                answer_positions=[encoded[job_idx][3] for job_idx in batch for _ in encoded[job_idx][0]],
+                answer_token_ids=[ids for job_idx in batch for ids in encoded[job_idx][2]],
+            )
+        outputs = agent.score_rows(
+            rows, labels_tokens, use_prefix_cache=use_prefix_cache,
+            prefix_groups=[job_idx for job_idx in batch for _ in encoded[job_idx][0]],
+            label_scoring="sum", **answer_kwargs,
         )
-        
-        scores.append(loss.item())
+        log_likelihoods, answer_log_probs = outputs if answer_token_ids is not None else (outputs, None)
+        log_likelihoods = log_likelihoods.float().cpu()
+        n_tokens = torch.tensor([len(tokens) for tokens in labels_tokens])
+        offset = 0
+        for job_idx in batch:
+            # The option rows are the last rows of the job
+            offset += len(encoded[job_idx][0])
+            option_rows = slice(offset - len(jobs[job_idx][1]), offset)
+            sum_nll = -log_likelihoods[option_rows]
+            results[job_idx] = {
+                "mean_nll": (sum_nll / n_tokens[option_rows]).numpy(),
+                "sum_nll": sum_nll.numpy(),
+            }
+            if answer_token_ids is not None:
+                results[job_idx]["answer_log_probs"] = [
+                    answer_log_probs[row, :len(ids)]
+                    for row, ids in zip(range(option_rows.start, option_rows.stop), answer_token_ids[job_idx])
+                ]
+        if on_batch is not None:
+            on_batch(batch, results)
+    return results
 
-    return -scores[0], -scores[1]
+def get_perplexity_scores(model, tokenizer, prompt, choice_a, choice_b):
+    """
+    Determines winner by prefilling the answer and checking which one 
+    has lower perplexity (higher likelihood): the negative mean NLL of each choice's tokens.
+    """
+    (scores,) = get_perplexity_scores_batch(model, tokenizer, [(prompt, [choice_a, choice_b])])
+    return -scores["mean_nll"][0].item(), -scores["mean_nll"][1].item()
 
 def get_single_token_prob(model, tokenizer, prompt_text, option_a, option_b):
     """
@@ -178,4 +220,58 @@ def get_single_token_prob(model, tokenizer, prompt_text, option_a, option_b):
             return probs[ids[0]].item()
         return 0.0 # Not a single token or not found
 
-    return get_prob(option_a), get_prob(option_b)
\ No newline at end of file
+    return get_prob(option_a), get_prob(option_b)
+
+def get_method_scores_batch(model, tokenizer, jobs, max_batch_tokens=4096, use_prefix_cache=True, on_batch=None):
+    """
+    Scores of the single, group and perplexity methods for many (prompt, option_a, option_b) jobs,
+    from the rows perplexity needs anyway (prompt + " " + option), scored by get_perplexity_scores_batch.
+    The LM head only runs on the option tokens and, once per job, on the last prompt position, whose
+    next-token distribution gives the single and group scores.
+    Returns, for every job, a dict with the score_single_*, score_group_* and score_ppl_* values, where
+    ppl is the negative mean NLL of the option tokens (any number of them).
+    on_batch(batch, results) runs after every batch with the indices of its jobs (see src.scheduler.score_jobs).
+    """
+    def single_ids(option):
+        ids = tokenizer.encode(option, add_special_tokens=False)
+        return ids if len(ids) == 1 else []
+
+    # Token ids read at the answer position: the single id (or none), then the group ids
+    answer_token_ids = [
+        [
+            [*single_ids(option_a), *get_candidate_token_ids(tokenizer, option_a, "A")],
+            [*single_ids(option_b), *get_candidate_token_ids(tokenizer, option_b, "B")],
+        ]
+        for _, option_a, option_b in jobs
+    ]
+
+    results = [None] * len(jobs)
+
+    def set_scores(batch, ppl_results):
+        for job_idx in batch:
+            _, option_a, option_b = jobs[job_idx]
+            scores = ppl_results[job_idx]
+            probs_a, probs_b = (log_probs.exp() for log_probs in scores["answer_log_probs"])
+            n_single_a, n_single_b = len(single_ids(option_a)), len(single_ids(option_b))
+            results[job_idx] = {
+                "score_single_a": probs_a[:n_single_a].sum().item(),
+                "score_single_b": probs_b[:n_single_b].sum().item(),
+                "score_group_a": probs_a[n_single_a:].sum().item(),
+                "score_group_b": probs_b[n_single_b:].sum().item(),
+                "score_ppl_a": -scores["mean_nll"][0].item(),
+                "score_ppl_b": -scores["mean_nll"][1].item(),
+            }
+        if on_batch is not None:
+            on_batch(batch, results)
+
+    get_perplexity_scores_batch(
+        model, tokenizer, [(prompt_text, [option_a, option_b]) for prompt_text, option_a, option_b in jobs],
+        max_batch_tokens=max_batch_tokens, use_prefix_cache=use_prefix_cache,
+        answer_token_ids=answer_token_ids, on_batch=set_scores,
+    )
+    return results
+
+def get_method_scores(model, tokenizer, prompt_text, option_a, option_b):
+    """Scores of the single, group and perplexity methods for one pair (see get_method_scores_batch)."""
+    (scores,) = get_method_scores_batch(model, tokenizer, [(prompt_text, option_a, option_b)])
+    return scores
@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+# Default root of the artifacts, next to the Hugging Face cache of HFAgent
+ARTIFACTS_DIR = os.path.join("huggingface", "artifacts")
+ARTIFACT_INFO = "artifact.json"
+DEVICE_MAPS = "device_maps.json"
+
+
+def artifact_path(root, model_id, dtype):
+    """Folder of the artifact of a model in a given dtype."""
+    return os.path.join(root, f"{model_id.replace('/', '--')}--{str(dtype).replace('torch.', '')}")
+
+
+def hardware_key(device_map):
+    """Identifies the GPUs a device map was resolved for (a resolved map is only valid on the same hardware)."""
+    gpus = [
+        f"{torch.cuda.get_device_name(i)}:{torch.cuda.get_device_properties(i).total_memory >> 20}MiB"
+        for i in range(torch.cuda.device_count())
+    ]
+    return json.dumps([device_map, gpus])
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    # Written to a temporary file first, so concurrent jobs never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _record_device_map(path, model, device_map):
+    """Records the device map "auto" resolved to on this hardware, for the next loads of the artifact."""
+    if device_map == "auto" and getattr(model, "hf_device_map", None):
+        device_maps = _read_json(os.path.join(path, DEVICE_MAPS))
+        device_maps[hardware_key(device_map)] = model.hf_device_map
+        _write_json(os.path.join(path, DEVICE_MAPS), device_maps)
+
+
+def save_model_artifact(root, model_id, model, tokenizer, device_map=None):
+    """
+    Stores a loaded model as a local artifact: safetensors weights in the model's dtype, its tokenizer,
+    the hub revision it came from and, for device_map="auto", the device map resolved for this hardware.
+    The weights are written once; later calls only record new device maps.
+    """
+    path = artifact_path(root, model_id, model.dtype)
+    if not os.path.exists(os.path.join(path, ARTIFACT_INFO)):
+        print(f"Saving {model_id} ({model.dtype}) to {path}...")
+        # Written next to the final folder and renamed, so a job never loads a partial artifact
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        tokenizer.save_pretrained(tmp_path)
+        _write_json(os.path.join(tmp_path, ARTIFACT_INFO), {
+            "model_id": model_id,
+            "revision": getattr(model.config, "_commit_hash", None),
+            "dtype": str(model.dtype),
+        })
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another job saved the same artifact first
+            shutil.rmtree(tmp_path)
+    _record_device_map(path, model, device_map)
+    return path
+
+
+def load_model_artifact(root, model_id, dtype, device_map=None):
+    """
+    Loads a model saved by save_model_artifact, or returns None if there is no artifact for it.
+    The weights are memory-mapped from local safetensors already in dtype (no download, no cast, works
+    offline), and device_map="auto" reuses the device map saved for this hardware when there is one.
+    Loading never writes the weights: artifacts are created once, by prepare_model_artifact.
+    """
+    path = artifact_path(root, model_id, dtype)
+    info = _read_json(os.path.join(path, ARTIFACT_INFO))
+    if not info:
+        return None
+
+    resolved_map = device_map
+    if device_map == "auto":
+        resolved_map = _read_json(os.path.join(path, DEVICE_MAPS)).get(hardware_key(device_map), device_map)
+    print(f"Loading {model_id} from {path}...")
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    model = AutoModelForCausalLM.from_pretrained(path, dtype=dtype, device_map=resolved_map, low_cpu_mem_usage=True)
+    model.eval()
+    # Keeps the hub revision in model_info (and so in the score cache keys)
+    model.config._commit_hash = info["revision"]
+    if resolved_map == "auto":
+        _record_device_map(path, model, device_map)
+    return model, tokenizer
+
+
+def prepare_model_artifact(root, model_id, dtype=torch.float16, cache_dir=None):
+    """Downloads a model and stores it as an artifact in dtype, e.g. on a node with internet access before a sweep."""
+    path = artifact_path(root, model_id, dtype)
+    if os.path.exists(os.path.join(path, ARTIFACT_INFO)):
+        print(f"{model_id} ({dtype}) is already in {path}")
+        return path
+    print(f"Loading {model_id}...")
+    tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=cache_dir)
+    model = AutoModelForCausalLM.from_pretrained(model_id, cache_dir=cache_dir, dtype=dtype, low_cpu_mem_usage=True)
+    return save_model_artifact(root, model_id, model, tokenizer)
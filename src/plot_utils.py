@@ -1,7 +1,8 @@
 import os
 import pandas as pd
 import numpy as np
-from src.pref_models import fit_bradley_terry
+from src.pref_models import build_template_wins, fit_bt_convergence
+from src.scores_io import read_scores, scores_path
 
 def calculate_bt_convergence(experiment_name, base_path='experiments', method='ppl'):
     """
@@ -23,12 +24,12 @@ def calculate_bt_convergence(experiment_name, base_path='experiments', method='p
         print(f"Loading cached convergence data from {cache_file_path}")
         return pd.read_csv(cache_file_path)
 
-    file_path = os.path.join(base_path, experiment_name, 'scores.csv')
-    if not os.path.exists(file_path):
-        print(f"Warning: File not found: {file_path}")
+    exp_dir = os.path.join(base_path, experiment_name)
+    if scores_path(exp_dir) is None:
+        print(f"Warning: No scores file found in {exp_dir}")
         return None
     
-    df = pd.read_csv(file_path)
+    df = read_scores(exp_dir)
     
     # Determine winner based on the selected method (Higher Score = Winner)
     if method == 'ppl':
@@ -54,20 +55,15 @@ def calculate_bt_convergence(experiment_name, base_path='experiments', method='p
     
     weights_history = []
     
-    # Accumulate data
-    for i, _ in enumerate(templates, 1):
-        current_templates = templates[:i]
-        subset_df = df[df['template'].isin(current_templates)]
-        
-        # fit_bradley_terry returns (ranking_df, wins_matrix)
-        # ranking_df has columns ['Color', 'BT_Score']
-        ranking, _ = fit_bradley_terry(subset_df, colors)
-        
+    # Accumulate data, one template at a time (warm-started incremental fits)
+    template_wins = build_template_wins(df, colors, templates)
+    history = fit_bt_convergence(template_wins)
+    for i, betas in enumerate(history, 1):
         # Create a dictionary of weights for this iteration
         weights = {'iteration': i, 'num_templates': i}
-        for _, row in ranking.iterrows():
+        for color, beta in zip(colors, betas):
             # Convert log-weights (beta) to "probabilities" (e^beta)
-            weights[row['Color']] = np.exp(row['BT_Score'])
+            weights[color] = np.exp(beta)
             
         weights_history.append(weights)
             
@@ -1,49 +1,259 @@
+import warnings
 import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+
 from scipy.optimize import minimize
+from scipy.sparse.csgraph import connected_components
 from scipy.special import expit
 
 
-def fit_bradley_terry(df, items):
+def _items_indices(values, items):
+    """Maps an array of item names to their indices in items."""
+    indices = pd.Index(items).get_indexer(values)
+    if (indices < 0).any():
+        unknown = sorted(set(np.asarray(values)[indices < 0]))
+        raise KeyError(f"Items not in the items list: {unknown}")
+    return indices
+
+
+def _hard_wins_indices(df, items):
+    """Indices of the winner and loser of every row (columns 'winner', 'item_a', 'item_b')."""
+    winner = df['winner'].to_numpy()
+    # Identifying the loser
+    loser = np.where(winner == df['item_a'].to_numpy(), df['item_b'].to_numpy(), df['item_a'].to_numpy())
+    return _items_indices(winner, items), _items_indices(loser, items)
+
+
+def _soft_wins_values(df, items):
+    """Indices of item_a and item_b of every row and the soft probability that item_a won."""
+    idx_a = _items_indices(df['item_a'].to_numpy(), items)
+    idx_b = _items_indices(df['item_b'].to_numpy(), items)
+    p_a_beats_b = expit(df['score_a'].to_numpy(dtype=float) - df['score_b'].to_numpy(dtype=float))
+    return idx_a, idx_b, p_a_beats_b
+
+
+def build_wins_matrix(df, items):
+    """wins[i][j] = number of rows in which items[i] beat items[j] (columns 'winner', 'item_a', 'item_b')."""
+    n = len(items)
+    wins = np.zeros((n, n))
+    np.add.at(wins, _hard_wins_indices(df, items), 1)
+    return wins
+
+
+def build_soft_wins_matrix(df, items):
     """
-    Fits the Bradley-Terry model using Maximum Likelihood Estimation.
-    P(i beats j) = exp(beta_i) / (exp(beta_i) + exp(beta_j))
+    Aggregates soft wins using the LLM's continuous scores:
+    soft_wins[a][b] += P(a beats b) = sigmoid(score_a - score_b), and soft_wins[b][a] += 1 - P(a beats b).
     """
     n = len(items)
-    item_to_idx = {item: i for i, item in enumerate(items)}
+    idx_a, idx_b, p_a_beats_b = _soft_wins_values(df, items)
+    soft_wins = np.zeros((n, n))
+    np.add.at(soft_wins, (idx_a, idx_b), p_a_beats_b)
+    np.add.at(soft_wins, (idx_b, idx_a), 1.0 - p_a_beats_b)
+    return soft_wins
 
-    # Initialize betas (scores) to 0
-    initial_betas = np.zeros(n)
 
-    # Prepare data for optimization
-    # We aggregate wins: wins[i][j] = number of times i beat j
-    wins = np.zeros((n, n))
-    for _, row in df.iterrows():
-        idx_w = item_to_idx[row['winner']]
-        # Identifying the loser
-        loser = row['item_b'] if row['winner'] == row['item_a'] else row['item_a']
-        idx_l = item_to_idx[loser]
-        wins[idx_w, idx_l] += 1
-
-    # Negative Log-Likelihood Function
-    def neg_log_likelihood(betas):
-        nll = 0
-        for i in range(n):
-            for j in range(n):
-                if wins[i, j] > 0:
-                    # Log Prob of i beating j
-                    prob_i_beats_j = np.exp(betas[i]) / (np.exp(betas[i]) + np.exp(betas[j]))
-                    nll -= wins[i, j] * np.log(prob_i_beats_j + 1e-9) # small epsilon
-                    nll += (wins[i, j] + wins[j, i]) * np.log(np.exp(betas[i]) + np.exp(betas[j]) + 1e-9)
-        return nll
-
-    # Constraint: Sum of betas = 0 (or beta_0 = 0) to fix scale.
-    # Here we typically center them or fix one. Let's just minimize.
-    res = minimize(neg_log_likelihood, initial_betas, method='BFGS')
+def build_template_wins(df, items, templates, soft=False):
+    """
+    Stack of (soft) wins matrices, one per template, built in a single pass over df:
+    template_wins[t] aggregates the rows whose 'template' is templates[t].
+    Rows of other templates are ignored.
+    """
+    n = len(items)
+    template_idx = pd.Index(templates).get_indexer(df['template'])
+    keep = template_idx >= 0
+    df, template_idx = df[keep], template_idx[keep]
+    template_wins = np.zeros((len(templates), n, n))
+    if soft:
+        idx_a, idx_b, p_a_beats_b = _soft_wins_values(df, items)
+        np.add.at(template_wins, (template_idx, idx_a, idx_b), p_a_beats_b)
+        np.add.at(template_wins, (template_idx, idx_b, idx_a), 1.0 - p_a_beats_b)
+    else:
+        np.add.at(template_wins, (template_idx, *_hard_wins_indices(df, items)), 1)
+    return template_wins
+
+
+def build_methods_template_wins(df, items, templates, score_columns, ties_to_a=True):
+    """
+    Hard wins stacks of several scoring methods at once, in a single grouped pass over df:
+    methods_wins[m, t] aggregates the rows of templates[t], the winner of a row being decided by
+    the pair of score columns score_columns[m] = (col_a, col_b) (higher score wins).
+    Ties go to item_a when ties_to_a is set, to item_b otherwise.
+    Returns a (M, T, n, n) array.
+    """
+    n = len(items)
+    template_idx = pd.Index(templates).get_indexer(df['template'])
+    keep = template_idx >= 0
+    df, template_idx = df[keep], template_idx[keep]
+    idx_a = _items_indices(df['item_a'].to_numpy(), items)
+    idx_b = _items_indices(df['item_b'].to_numpy(), items)
+
+    # (M, rows) matrix of "item_a won" for all methods
+    scores_a = np.stack([df[col_a].to_numpy(dtype=float) for col_a, _ in score_columns])
+    scores_b = np.stack([df[col_b].to_numpy(dtype=float) for _, col_b in score_columns])
+    a_won = scores_a >= scores_b if ties_to_a else scores_a > scores_b
+
+    method_idx = np.repeat(np.arange(len(score_columns)), len(df))
+    winner = np.where(a_won, idx_a, idx_b).ravel()
+    loser = np.where(a_won, idx_b, idx_a).ravel()
+    methods_wins = np.zeros((len(score_columns), len(templates), n, n))
+    np.add.at(methods_wins, (method_idx, np.tile(template_idx, len(score_columns)), winner, loser), 1)
+    return methods_wins
+
+
+def bt_neg_log_likelihood(betas, wins):
+    """
+    Negative log-likelihood of a (possibly soft) wins matrix under Bradley-Terry, and its gradient.
+    NLL = -sum_ij wins[i][j] * log P(i beats j), with log P(i beats j) = beta_i - log(exp(beta_i) + exp(beta_j))
+    """
+    diff = betas[:, None] - betas[None, :]
+    # log P(i beats j) = -log(1 + exp(beta_j - beta_i))
+    nll = np.sum(wins * np.logaddexp(0, -diff))
+    # d(-log P(i beats j))/d(beta_i) = -P(j beats i)
+    p_lose = expit(-diff)
+    weighted = wins * p_lose
+    grad = weighted.sum(axis=0) - weighted.sum(axis=1)
+    return nll, grad
+
+
+def bt_hessian(betas, wins):
+    """Hessian of bt_neg_log_likelihood (a weighted graph Laplacian, so only positive semi-definite)."""
+    diff = betas[:, None] - betas[None, :]
+    p = expit(diff)
+    weights = (wins + wins.T) * p * (1 - p)
+    hessian = -weights
+    np.fill_diagonal(hessian, weights.sum(axis=1) - np.diag(weights))
+    return hessian
+
+
+def _fit_bt_mm_strongly_connected(wins, log_pi, tol, max_iter):
+    """MM iterations on a strongly connected wins matrix (where the MLE exists), centered log-scores."""
+    comparisons = wins + wins.T
+    log_total_wins = np.log(wins.sum(axis=1))
+    log_pi = log_pi - log_pi.mean()
+    for _ in range(max_iter):
+        pi = np.exp(log_pi)
+        denominator = (comparisons / (pi[:, None] + pi[None, :])).sum(axis=1)
+        new_log_pi = log_total_wins - np.log(denominator)
+        new_log_pi -= new_log_pi.mean()
+        converged = np.max(np.abs(new_log_pi - log_pi)) < tol
+        log_pi = new_log_pi
+        if converged:
+            break
+    return log_pi
+
+
+def add_prior_wins(wins, prior):
+    """
+    Wins matrix with prior pseudo-wins added both ways to every compared pair: a symmetric prior that
+    shrinks the scores towards each other and makes every connected comparison graph strongly
+    connected, so the MLE always exists. Pairs that were never compared get no pseudo-wins.
+    """
+    if not prior:
+        return wins
+    return wins + prior * ((wins + wins.T) > 0)
+
+
+def identifiable_items(wins):
+    """
+    Mask of the items with a finite Bradley-Terry MLE: items that were compared, in a connected component
+    whose "i beat j" graph is strongly connected (the scores of a component are only defined up to a shift).
+    """
+    _, component_labels = connected_components((wins + wins.T) > 0, directed=False)
+    _, scc_labels = connected_components(wins > 0, directed=True, connection='strong')
+    mask = np.zeros(wins.shape[0], dtype=bool)
+    for component in np.unique(component_labels):
+        members = np.flatnonzero(component_labels == component)
+        mask[members] = len(members) > 1 and len(np.unique(scc_labels[members])) == 1
+    return mask
+
+
+def fit_bt_mm(wins, initial_betas=None, tol=1e-8, max_iter=10000, prior=0.0):
+    """
+    Minorization-maximization (Zermelo / Hunter 2004) fixed point for Bradley-Terry:
+    pi_i <- W_i / sum_j N_ij / (pi_i + pi_j), with W_i the wins of i and N_ij the comparisons of i and j.
+    Works for soft wins too. Every iteration is a few O(n^2) array ops and there is no line search.
+    Stops when no log-score moves by more than tol.
+
+    Disconnected comparison graphs are fitted per connected component, each centered on its own.
+    Items that were never compared get NaN. The MLE is finite only when the "i beat j" graph of a
+    component is strongly connected; when it is not (e.g. a group of items never loses to the others)
+    the component's scores are not identifiable: they are NaN and a warning names the items.
+    prior > 0 adds pseudo-wins to every compared pair (see add_prior_wins), so every component has a finite,
+    regularized estimate.
+    """
+    wins = add_prior_wins(wins, prior)
+    n = wins.shape[0]
+    log_pi = np.zeros(n) if initial_betas is None else np.nan_to_num(np.array(initial_betas, dtype=float))
+    betas = np.full(n, np.nan)
+    identifiable = identifiable_items(wins)
+    _, component_labels = connected_components((wins + wins.T) > 0, directed=False)
+    for component in np.unique(component_labels[identifiable]):
+        members = np.flatnonzero(component_labels == component)
+        betas[members] = _fit_bt_mm_strongly_connected(wins[np.ix_(members, members)], log_pi[members], tol, max_iter)
+
+    compared = (wins + wins.T).sum(axis=1) > 0
+    not_identifiable = np.flatnonzero(compared & ~identifiable).tolist()
+    if not_identifiable:
+        warnings.warn(
+            f"No finite Bradley-Terry MLE for the items at indices {not_identifiable} (their win graph is not strongly "
+            f"connected), their scores are NaN; pass prior > 0 to regularize the fit"
+        )
+    return betas
+
+
+def fit_bt_wins(wins, initial_betas=None, solver='BFGS', tol=None, prior=0.0):
+    """
+    Maximum likelihood Bradley-Terry scores of an aggregated (possibly soft) wins matrix.
+    solver is 'mm' (see fit_bt_mm) or any scipy.optimize.minimize method; methods that use a Hessian
+    (e.g. 'trust-exact', 'Newton-CG') get the analytic one.
+    initial_betas warm-starts the solver (e.g. from a fit on a subset of the data).
+    prior > 0 regularizes the fit with pseudo-wins (see add_prior_wins).
+    Returns the scores centered to sum to 0.
+    """
+    if solver == 'mm':
+        return fit_bt_mm(wins, initial_betas=initial_betas, prior=prior, **({} if tol is None else {'tol': tol}))
+
+    wins = add_prior_wins(wins, prior)
+
+    n = wins.shape[0]
+    initial_betas = np.zeros(n) if initial_betas is None else np.nan_to_num(np.array(initial_betas, dtype=float))
+    hess = bt_hessian if solver in ('trust-exact', 'trust-krylov', 'trust-ncg', 'Newton-CG', 'dogleg') else None
+    res = minimize(bt_neg_log_likelihood, initial_betas, args=(wins,), jac=True, hess=hess, method=solver, tol=tol)
 
     # Normalize scores so they sum to 0 for easier interpretation
-    final_betas = res.x - np.mean(res.x)
+    return res.x - np.mean(res.x)
+
+
+def fit_bt_convergence(template_wins, solver='BFGS'):
+    """
+    Bradley-Terry scores after each prefix of templates, as in refitting on templates[:i] for every i,
+    but incrementally: a running wins matrix gets one template's contribution at a time and every fit
+    is warm-started from the previous one, so a whole curve costs about as much as a single fit.
+    template_wins is a (T, n, n) stack as returned by build_template_wins.
+    Returns a (T, n) array, row i holding the scores fitted on the first i + 1 templates.
+    """
+    n_templates, n, _ = template_wins.shape
+    history = np.zeros((n_templates, n))
+    wins = np.zeros((n, n))
+    betas = None
+    for i in range(n_templates):
+        wins += template_wins[i]
+        betas = fit_bt_wins(wins, initial_betas=betas, solver=solver)
+        history[i] = betas
+    return history
+
+
+def fit_bradley_terry(df, items, solver='BFGS'):
+    """
+    Fits the Bradley-Terry model using Maximum Likelihood Estimation.
+    P(i beats j) = exp(beta_i) / (exp(beta_i) + exp(beta_j))
+    """
+    # We aggregate wins: wins[i][j] = number of times i beat j
+    wins = build_wins_matrix(df, items)
+    final_betas = fit_bt_wins(wins, solver=solver)
 
     ranking = pd.DataFrame({
         'Item': items,
@@ -52,47 +262,14 @@ def fit_bradley_terry(df, items):
 
     return ranking, wins
 
-def fit_BT_soft(df, items):
+def fit_BT_soft(df, items, solver='BFGS'):
     """
     Fits the Bradley-Terry model using Cross-Entropy on soft probabilities.
     P(i beats j) = exp(beta_i) / (exp(beta_i) + exp(beta_j))
-    """    
-    n = len(items)
-    item_to_idx = {item: i for i, item in enumerate(items)}
-
-    # Initialize betas (scores) to 0
-    initial_betas = np.zeros(n)
-
-    # Prepare data for optimization
+    """
     # We aggregate soft wins using the LLM's continuous perplexity scores
-    soft_wins = np.zeros((n, n))
-    for _, row in df.iterrows():
-        idx_a = item_to_idx[row['item_a']]
-        idx_b = item_to_idx[row['item_b']]
-        
-        # Soft probability that A beats B based on LLM scores
-        p_a_beats_b = expit(row['score_a'] - row['score_b'])
-        
-        soft_wins[idx_a, idx_b] += p_a_beats_b
-        soft_wins[idx_b, idx_a] += (1.0 - p_a_beats_b)
-
-    # Negative Log-Likelihood (Cross-Entropy) Function
-    def neg_log_likelihood(betas):
-        nll = 0
-        for i in range(n):
-            for j in range(n):
-                if soft_wins[i, j] > 0:
-                    # Log Prob of i beating j: beta_i - log(exp(beta_i) + exp(beta_j))
-                    log_p_ij = betas[i] - np.logaddexp(betas[i], betas[j])
-                    nll -= soft_wins[i, j] * log_p_ij
-        return nll
-
-    # Constraint: Sum of betas = 0 (or beta_0 = 0) to fix scale.
-    # Here we typically center them or fix one. Let's just minimize.
-    res = minimize(neg_log_likelihood, initial_betas, method='BFGS')
-
-    # Normalize scores so they sum to 0 for easier interpretation
-    final_betas = res.x - np.mean(res.x)
+    soft_wins = build_soft_wins_matrix(df, items)
+    final_betas = fit_bt_wins(soft_wins, solver=solver)
 
     ranking = pd.DataFrame({
         'Item': items,
@@ -100,3 +277,87 @@ def fit_BT_soft(df, items):
     })
 
     return ranking, soft_wins
+
+
+def _bootstrap_units(df, unit):
+    """Unit id of every row: its template, or its unordered pair of items."""
+    if unit == 'template':
+        return pd.factorize(df['template'])[0]
+    if unit == 'pair':
+        first = np.minimum(df['item_a'].astype(str).to_numpy(), df['item_b'].astype(str).to_numpy())
+        second = np.maximum(df['item_a'].astype(str).to_numpy(), df['item_b'].astype(str).to_numpy())
+        return pd.MultiIndex.from_arrays([first, second]).factorize()[0]
+    raise ValueError(f"Unknown bootstrap unit: {unit}")
+
+
+def _bootstrap_worker(unit_idx, cell_idx, values, n_units, n, initial_betas, solver, prior, n_replicates, seed):
+    rng = np.random.default_rng(seed)
+    replicates = np.zeros((n_replicates, n))
+    for r in range(n_replicates):
+        # Resampling units with replacement = weighting every unit by its multiplicity
+        counts = rng.multinomial(n_units, np.full(n_units, 1.0 / n_units))
+        wins = np.bincount(cell_idx, weights=counts[unit_idx] * values, minlength=n * n).reshape(n, n)
+        replicates[r] = fit_bt_wins(wins, initial_betas=initial_betas, solver=solver, prior=prior)
+    return replicates
+
+
+def bootstrap_bradley_terry(df, items, unit='template', n_boot=500, alpha=0.05, soft=False,
+                            solver='mm', n_jobs=1, seed=0, prior=0.5):
+    """
+    Bootstrap confidence intervals of Bradley-Terry scores.
+    Resamples whole units with replacement - templates (unit='template') or unordered pairs of items
+    (unit='pair') - and refits BT n_boot times. Every unit's contribution to the wins matrix is
+    aggregated once, so a replicate is a single bincount plus a fit warm-started from the full-data
+    scores. Replicates are split across n_jobs worker processes.
+    Needs a 'winner' column, or score_a / score_b with soft=True.
+
+    Resampled win graphs are often not strongly connected, so the full-data fit and every replicate
+    are regularized with prior pseudo-wins per compared pair (see add_prior_wins). This keeps the
+    intervals coming from the data. With prior=0, items without a finite MLE in a replicate make its
+    statistics NaN.
+
+    Returns a DataFrame with columns Item, BT_Score (full data), BT_Std, CI_Low and CI_High
+    (the alpha / 2 and 1 - alpha / 2 quantiles of the replicates, NaN for items never compared) and
+    Identifiable (whether the unregularized full-data MLE of the item exists).
+    """
+    n = len(items)
+    units = _bootstrap_units(df, unit)
+    if soft:
+        idx_a, idx_b, p_a_beats_b = _soft_wins_values(df, items)
+        unit_idx = np.concatenate([units, units])
+        cells = np.concatenate([idx_a * n + idx_b, idx_b * n + idx_a])
+        values = np.concatenate([p_a_beats_b, 1.0 - p_a_beats_b])
+    else:
+        winner, loser = _hard_wins_indices(df, items)
+        unit_idx, cells, values = units, winner * n + loser, np.ones(len(df))
+
+    # Aggregate the rows into one entry per (unit, cell)
+    n_units = units.max() + 1
+    keys, inverse = np.unique(unit_idx * (n * n) + cells, return_inverse=True)
+    values = np.bincount(inverse, weights=values)
+    unit_idx, cell_idx = keys // (n * n), keys % (n * n)
+
+    full_wins = np.bincount(cell_idx, weights=values, minlength=n * n).reshape(n, n)
+    full_betas = fit_bt_wins(full_wins, solver=solver, prior=prior)
+
+    n_jobs = max(1, min(n_jobs, n_boot))
+    chunks = [len(chunk) for chunk in np.array_split(np.arange(n_boot), n_jobs)]
+    seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+    args = [
+        (unit_idx, cell_idx, values, n_units, n, full_betas, solver, prior, chunk, s) for chunk, s in zip(chunks, seeds)
+    ]
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            replicates = list(pool.map(_bootstrap_worker, *zip(*args)))
+    else:
+        replicates = [_bootstrap_worker(*a) for a in args]
+    replicates = np.concatenate(replicates)
+
+    return pd.DataFrame({
+        'Item': items,
+        'BT_Score': full_betas,
+        'BT_Std': replicates.std(axis=0),
+        'CI_Low': np.quantile(replicates, alpha / 2, axis=0),
+        'CI_High': np.quantile(replicates, 1 - alpha / 2, axis=0),
+        'Identifiable': identifiable_items(full_wins),
+    })
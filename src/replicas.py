@@ -0,0 +1,127 @@
+import os
+import queue
+import traceback
+import multiprocessing
+import torch
+
+from src.scheduler import score_jobs
+from src.score_cache import ScoreCache
+
+
+def _replica_worker(replica, agent_loader, loader_args, device_map, n_threads, score_cache_path, tasks, messages):
+    try:
+        torch.set_num_threads(n_threads)
+        agent = agent_loader(*loader_args, device_map=device_map)
+        if score_cache_path:
+            agent.score_cache = ScoreCache(score_cache_path)
+        messages.put(("ready", replica, agent.model_id))
+    except Exception:
+        messages.put(("error", replica, traceback.format_exc()))
+        return
+
+    for task in iter(tasks.get, None):
+        job_indices, jobs, kwargs = task
+        try:
+            def send_batch(batch, results):
+                messages.put(("batch", replica, [job_indices[i] for i in batch], [results[i] for i in batch]))
+            results = score_jobs(agent, jobs, on_batch=send_batch, progress=replica == 0, **kwargs)
+            # Jobs served by the score cache never went through a batch
+            messages.put(("done", replica, job_indices, results))
+        except Exception:
+            messages.put(("error", replica, traceback.format_exc()))
+
+
+class ReplicaPool:
+    """
+    Data-parallel scoring for small models: every worker process loads its own full copy of the model
+    (pinned to one GPU, or on CPU with a share of the cores) and scores an interleaved slice of the jobs.
+
+    The replicas are loaded once and reused by every score_jobs call (e.g. all the sets of a sweep).
+    Results stream back per batch, so on_batch callbacks (the crash-safe scores log) keep working,
+    and are returned in the order of the jobs. Models that do not fit on one GPU should keep
+    using a single agent with device_map="auto".
+    """
+
+    def __init__(self, agent_loader, loader_args=(), n_replicas=2, score_cache_path=None, poll_interval=10):
+        self.n_replicas = n_replicas
+        self.poll_interval = poll_interval
+        n_gpus = torch.cuda.device_count()
+        # Tokenization and the CPU forward passes would oversubscribe the cores without a per-process cap
+        n_threads = max(1, (os.cpu_count() or 1) // n_replicas)
+        ctx = multiprocessing.get_context("spawn")
+        self._messages = ctx.Queue()
+        self._tasks = [ctx.Queue() for _ in range(n_replicas)]
+        self._processes = [
+            ctx.Process(
+                target=_replica_worker,
+                args=(
+                    replica, agent_loader, loader_args, {"": replica % n_gpus} if n_gpus else None, n_threads,
+                    score_cache_path, self._tasks[replica], self._messages,
+                ),
+                daemon=True,
+            )
+            for replica in range(n_replicas)
+        ]
+        for process in self._processes:
+            process.start()
+        print(f"Loading {n_replicas} replicas ({f'{n_gpus} GPUs' if n_gpus else f'CPU, {n_threads} threads each'})")
+
+        model_ids = []
+        for _ in range(n_replicas):
+            message = self._get_message()
+            model_ids.append(message[2])
+        self.model_id = model_ids[0]
+
+    def _get_message(self):
+        # A replica that dies without a message (OOM kill, CUDA abort, import error) would block get() forever
+        while True:
+            try:
+                message = self._messages.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                dead = [
+                    (replica, process.exitcode) for replica, process in enumerate(self._processes)
+                    if not process.is_alive()
+                ]
+                if dead:
+                    self.close()
+                    raise RuntimeError(
+                        "Replicas died: " + ", ".join(f"{replica} (exit code {code})" for replica, code in dead)
+                    )
+        if message[0] == "error":
+            self.close()
+            raise RuntimeError(f"Replica {message[1]} failed:\n{message[2]}")
+        return message
+
+    def score_jobs(self, jobs, on_batch=None, **kwargs):
+        """Same as scheduler.score_jobs, with the jobs split across the replicas."""
+        # Interleaving gives every replica the same mix of templates and prompt lengths
+        for replica in range(self.n_replicas):
+            job_indices = list(range(replica, len(jobs), self.n_replicas))
+            self._tasks[replica].put((job_indices, [jobs[i] for i in job_indices], kwargs))
+
+        results = [None] * len(jobs)
+        n_done = 0
+        while n_done < self.n_replicas:
+            kind, _, job_indices, scores = self._get_message()
+            for job_idx, job_scores in zip(job_indices, scores):
+                results[job_idx] = job_scores
+            if kind == "batch" and on_batch is not None:
+                on_batch(job_indices, results)
+            elif kind == "done":
+                n_done += 1
+        return results
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
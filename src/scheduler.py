@@ -0,0 +1,156 @@
+import torch
+from tqdm.auto import tqdm
+
+
+def pack_batches(lengths, rows_per_job, max_batch_tokens):
+    """
+    Greedily packs consecutive jobs into batches.
+    A batch is closed when its padded size (rows x longest row) would exceed max_batch_tokens.
+    A single job larger than the budget gets a batch of its own.
+    Returns a list of batches, each a list of job indices.
+    """
+    batches = []
+    current, current_rows, current_max_len = [], 0, 0
+    for job_idx, (length, n_rows) in enumerate(zip(lengths, rows_per_job)):
+        new_rows = current_rows + n_rows
+        new_max_len = max(current_max_len, length)
+        if current and new_rows * new_max_len > max_batch_tokens:
+            batches.append(current)
+            current, new_rows, new_max_len = [], n_rows, length
+        current.append(job_idx)
+        current_rows, current_max_len = new_rows, new_max_len
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_stats(batches, row_lengths):
+    """
+    Summarizes how much of the padded batches is real tokens.
+    row_lengths[job_idx] is the list of token lengths of the rows of that job.
+    """
+    real_tokens, padded_tokens = 0, 0
+    for batch in batches:
+        lengths = [length for job_idx in batch for length in row_lengths[job_idx]]
+        real_tokens += sum(lengths)
+        padded_tokens += len(lengths) * max(lengths)
+    return {
+        "batches": len(batches),
+        "real_tokens": real_tokens,
+        "padded_tokens": padded_tokens,
+        "padding_efficiency": real_tokens / padded_tokens if padded_tokens else 1.0,
+    }
+
+
+def score_jobs(agent, jobs, max_batch_tokens=4096, use_prefix_cache=False, sort_by_length=True, progress=True,
+               on_batch=None, label_scoring="last_token", top_k=0):
+    """
+    Scores a stream of (prompt, labels) jobs with as few forward passes as possible.
+    A job's prompt may also be a list of prompts sharing the same labels (e.g. both orderings of a pair);
+    its rows are then laid out as in agent.encode_query and always land in the same batch.
+    Jobs are tokenized once, bucketed by token length (when sort_by_length is set), packed into
+    padded batches of up to max_batch_tokens tokens, scored by agent.score_rows and scattered back.
+
+    When the agent has a score cache, jobs whose rows are all cached are not sent to the model,
+    and the scores of every scored batch are written back to the cache.
+    on_batch(job_indices, results) is called after every scored batch, e.g. to stream its results to disk.
+    label_scoring picks how multi-token labels are scored (see agent.encode_query).
+
+    Returns a list with the labels scores tensor of every job, in the order of the jobs.
+    With top_k > 0, the top_k next-token ids and log probabilities at the answer position of every
+    prompt are captured from the same forward passes (see agent.score_rows), and every job's result is
+    (scores, top_k_ids, top_k_log_probs) with (n_prompts, top_k) int32 / float16 arrays. The score
+    cache is then only written to, as cached jobs would have no top-k to report.
+    """
+    results = [None] * len(jobs)
+    score_cache = getattr(agent, "score_cache", None)
+    job_keys = None
+    if score_cache is not None:
+        job_keys = [agent.cache_keys(prompt, labels, label_scoring) for prompt, labels in jobs]
+    if score_cache is not None and not top_k:
+        cached = score_cache.get_many([key for keys in job_keys for key in keys])
+        for job_idx, keys in enumerate(job_keys):
+            if all(key in cached for key in keys):
+                results[job_idx] = torch.tensor([cached[key] for key in keys])
+        n_cached = sum(result is not None for result in results)
+        print(f"Score cache: {n_cached}/{len(jobs)} jobs already scored")
+
+    pending = [job_idx for job_idx, result in enumerate(results) if result is None]
+    encoded, row_lengths = {}, {}
+    for job_idx in pending:
+        prompt, labels = jobs[job_idx]
+        encoded[job_idx] = agent.encode_query(prompt, labels, label_scoring)
+        row_lengths[job_idx] = [len(ids) for ids in encoded[job_idx][0]]
+        if top_k:
+            encoded[job_idx] += (agent.answer_positions(prompt, labels),)
+    token_cache = getattr(agent, "token_cache", None)
+    if token_cache is not None and pending:
+        rates = token_cache.hit_rates()
+        print(f"Tokenization cache: {rates['prompts']:.1%} prompt hits, {rates['labels']:.1%} label hits, "
+              f"{rates['row_fallbacks']} rows tokenized in full")
+    lengths = {job_idx: max(job_lengths) for job_idx, job_lengths in row_lengths.items()}
+    rows_per_job = {job_idx: len(job_lengths) for job_idx, job_lengths in row_lengths.items()}
+
+    # Neighbouring jobs of similar length pad to almost nothing. The sort is stable,
+    # so equal-length jobs keep their stream order (and their shared prefixes).
+    order = list(pending)
+    if sort_by_length:
+        order.sort(key=lambda job_idx: lengths[job_idx])
+    batches = pack_batches(
+        [lengths[job_idx] for job_idx in order],
+        [rows_per_job[job_idx] for job_idx in order],
+        max_batch_tokens,
+    )
+    batches = [[order[i] for i in batch] for batch in batches]
+
+    stats = padding_stats(batches, row_lengths)
+    print(f"Scoring {len(pending)} jobs in {stats['batches']} batches "
+          f"(padding efficiency: {stats['padding_efficiency']:.1%})")
+
+    for batch in tqdm(batches, desc="Scoring batches", disable=not progress):
+        input_ids = [ids for job_idx in batch for ids in encoded[job_idx][0]]
+        labels_tokens = [tok for job_idx in batch for tok in encoded[job_idx][1]]
+        # Rows of the same prompt of the same job share their prefix
+        prefix_groups = [
+            (job_idx, prompt_idx)
+            for job_idx in batch
+            for prompt_idx in agent.prompt_groups(*jobs[job_idx])
+        ]
+        if top_k:
+            scores, top_k_ids, top_k_log_probs = agent.score_rows(
+                input_ids, labels_tokens, use_prefix_cache=use_prefix_cache, prefix_groups=prefix_groups,
+                label_scoring=label_scoring, top_k=top_k,
+                answer_positions=[pos for job_idx in batch for pos in encoded[job_idx][2]],
+            )
+        else:
+            scores = agent.score_rows(
+                input_ids, labels_tokens, use_prefix_cache=use_prefix_cache, prefix_groups=prefix_groups,
+                label_scoring=label_scoring,
+            )
+        scores = scores.cpu()
+
+        # Scatter the rows back to their jobs
+        offset = 0
+        for job_idx in batch:
+            n_rows = rows_per_job[job_idx]
+            results[job_idx] = scores[offset:offset + n_rows]
+            if top_k:
+                # Rows are label-major, so the first rows of a job are its prompts in order
+                n_prompts = len(set(agent.prompt_groups(*jobs[job_idx])))
+                results[job_idx] = (
+                    results[job_idx],
+                    top_k_ids[offset:offset + n_prompts],
+                    top_k_log_probs[offset:offset + n_prompts],
+                )
+            offset += n_rows
+
+        if score_cache is not None:
+            score_cache.put_many(
+                (key, score.item())
+                for job_idx in batch
+                for key, score in zip(job_keys[job_idx], (results[job_idx][0] if top_k else results[job_idx]).float())
+            )
+        if on_batch is not None:
+            on_batch(batch, results)
+
+    return results
@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+class ScoreCache:
+    """
+    Persistent, content-addressed cache of label scores.
+
+    Every scored row is stored under a hash of everything that determines its value
+    (model id + revision, dtype, system prompt, fully rendered prompt, label and scoring method),
+    so re-running a sweep after editing a few templates only pays for the new rows.
+
+    Backed by a single SQLite file. Writers from several SLURM jobs serialize on the database lock
+    (keep the file on a file system with working POSIX locks), and the least recently used rows are
+    evicted once the cache grows beyond max_entries. Rows are only counted when the running count of
+    this process (rows at connection time + rows written since) crosses the bound, and the recency of
+    the hits of a lookup is written once per get_many, so lookups stay cheap.
+    """
+    _CHUNK = 500
+
+    def __init__(self, path, max_entries=5_000_000, timeout=120):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._n_entries = None
+        dir_name = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_name, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "key TEXT PRIMARY KEY, score REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+
+    def _connection(self):
+        # sqlite connections must not be shared across forked worker processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self._pid = os.getpid()
+            self._n_entries = None
+        return self._conn
+
+    @staticmethod
+    def make_key(model_info, system_prompt, prompt, label, method="last_token"):
+        payload = json.dumps([model_info, system_prompt, prompt, label, method], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Returns a {key: score} dict of the keys found in the cache."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        conn = self._connection()
+        for start in range(0, len(keys), self._CHUNK):
+            chunk = keys[start:start + self._CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(conn.execute(
+                f"SELECT key, score FROM scores WHERE key IN ({placeholders})", chunk
+            ).fetchall())
+        if found:
+            # A single write transaction refreshes the recency of all the hits
+            now = time.time()
+            with conn:
+                conn.executemany("UPDATE scores SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        return found
+
+    def put_many(self, items):
+        """Stores (key, score) pairs, evicting the least recently used rows if needed."""
+        items = [(key, float(score)) for key, score in items]
+        if not items:
+            return
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO scores (key, score, last_used) VALUES (?, ?, ?)",
+                [(key, score, now) for key, score in items],
+            )
+            self._evict(conn, len(items))
+
+    def _evict(self, conn, n_written):
+        # The running count is approximate (replaced rows are counted again, rows of other writers
+        # are not): it only decides when the rows are counted for real
+        if self._n_entries is None:
+            (self._n_entries,) = conn.execute("SELECT COUNT(*) FROM scores").fetchone()
+        else:
+            self._n_entries += n_written
+        if self._n_entries <= self.max_entries:
+            return
+        (n_entries,) = conn.execute("SELECT COUNT(*) FROM scores").fetchone()
+        self._n_entries = n_entries
+        if n_entries <= self.max_entries:
+            return
+        # Evict down to 90% of the bound, so we do not evict on every single write
+        n_evict = n_entries - int(self.max_entries * 0.9)
+        conn.execute(
+            "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)",
+            (n_evict,),
+        )
+        self._n_entries -= n_evict
+
+    def __len__(self):
+        (n_entries,) = self._connection().execute("SELECT COUNT(*) FROM scores").fetchone()
+        return n_entries
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SCORES_PARQUET = "scores.parquet"
+SCORES_CSV = "scores.csv"
+SCORES_LOG = "scores.log.jsonl"
+TOP_K = "top_k.npz"
+
+# Low-cardinality text columns, stored dictionary-encoded (pandas categoricals)
+CATEGORICAL_COLUMNS = ['template', 'option_a', 'option_b', 'item_a', 'item_b', 'winner']
+# Pairs of item columns a rendered prompt can be rebuilt from (template.format(A=..., B=...))
+ITEM_COLUMNS = [('option_a', 'option_b'), ('item_a', 'item_b')]
+# Parquet metadata key set when write_scores dropped the 'prompt' column (read_scores then rebuilds it)
+PROMPT_DROPPED_KEY = b"scores_io.prompt_dropped"
+
+
+def _item_columns(columns):
+    for col_a, col_b in ITEM_COLUMNS:
+        if col_a in columns and col_b in columns:
+            return col_a, col_b
+    return None
+
+
+def _render_prompts(df, col_a, col_b):
+    return [
+        template.format(A=a, B=b)
+        for template, a, b in zip(df['template'].astype(str), df[col_a].astype(str), df[col_b].astype(str))
+    ]
+
+
+def to_columnar(df):
+    """
+    Compact copy of a scores DataFrame: text columns become categoricals, score columns float32,
+    and the rendered 'prompt' column is dropped when it can be rebuilt from its template.
+    """
+    df = df.drop(columns=[c for c in df.columns if c.startswith('Unnamed:')])
+    item_columns = _item_columns(df.columns)
+    if 'prompt' in df.columns and 'template' in df.columns and item_columns:
+        if list(df['prompt'].astype(str)) == _render_prompts(df, *item_columns):
+            df = df.drop(columns=['prompt'])
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype('category')
+        elif col.startswith('score') and pd.api.types.is_float_dtype(df[col]):
+            df[col] = df[col].astype('float32')
+    return df
+
+
+def write_scores(df, exp_dir, file_format="parquet"):
+    """Writes the scores of an experiment as scores.parquet (columnar) or scores.csv. Returns the path."""
+    if file_format == "csv":
+        path = os.path.join(exp_dir, SCORES_CSV)
+        df.to_csv(path, index=False)
+    elif file_format == "parquet":
+        path = os.path.join(exp_dir, SCORES_PARQUET)
+        columnar = to_columnar(df)
+        table = pa.Table.from_pandas(columnar, preserve_index=False)
+        if 'prompt' in df.columns and 'prompt' not in columnar.columns:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), PROMPT_DROPPED_KEY: b"1"})
+        pq.write_table(table, path)
+    else:
+        raise ValueError(f"Unknown scores format: {file_format}")
+    return path
+
+
+def scores_path(exp_dir):
+    """Path of the scores file of an experiment (parquet preferred), or None if there is none."""
+    for name in (SCORES_PARQUET, SCORES_CSV):
+        path = os.path.join(exp_dir, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_scores(exp_dir, columns=None):
+    """
+    Reads the scores of an experiment folder, from scores.parquet if present, scores.csv otherwise.
+    With parquet only the requested columns are read; a 'prompt' column dropped by write_scores is rebuilt
+    on demand (files written without one get none).
+    """
+    path = scores_path(exp_dir)
+    if path is None:
+        raise FileNotFoundError(f"No {SCORES_PARQUET} or {SCORES_CSV} in {exp_dir}")
+    if path.endswith(".csv"):
+        df = pd.read_csv(path)
+        return df if columns is None else df[columns]
+
+    schema = pq.read_schema(path)
+    available = schema.names
+    item_columns = _item_columns(available)
+    prompt_dropped = PROMPT_DROPPED_KEY in (schema.metadata or {})
+    can_rebuild_prompt = prompt_dropped and 'prompt' not in available and 'template' in available and item_columns is not None
+    if columns is None:
+        df = pd.read_parquet(path)
+        if can_rebuild_prompt:
+            df.insert(df.columns.get_loc(item_columns[1]) + 1, 'prompt', _render_prompts(df, *item_columns))
+        return df
+
+    # Only read the requested columns, plus what a dropped prompt column is rebuilt from
+    rebuild_prompt = 'prompt' in columns and can_rebuild_prompt
+    read_columns = [c for c in columns if not (rebuild_prompt and c == 'prompt')]
+    if rebuild_prompt:
+        read_columns = list(dict.fromkeys(read_columns + ['template', *item_columns]))
+    df = pd.read_parquet(path, columns=read_columns)
+    if rebuild_prompt:
+        df['prompt'] = _render_prompts(df, *item_columns)
+    return df[columns]
+
+
+def convert_scores_csv(exp_dir, remove_csv=False):
+    """Converts the scores.csv of an experiment folder to scores.parquet. Returns the new path."""
+    df = pd.read_csv(os.path.join(exp_dir, SCORES_CSV))
+    path = write_scores(df, exp_dir, file_format="parquet")
+    if remove_csv:
+        os.remove(os.path.join(exp_dir, SCORES_CSV))
+    return path
+
+
+def write_top_k(exp_dir, token_ids, log_probs):
+    """
+    Writes the top-k next-token ids and log probabilities at the answer position of every scores row,
+    as (n_rows, k) int32 / float16 arrays aligned with the rows of the scores file. Returns the path.
+    """
+    path = os.path.join(exp_dir, TOP_K)
+    np.savez(path, token_ids=np.asarray(token_ids, dtype=np.int32), log_probs=np.asarray(log_probs, dtype=np.float16))
+    return path
+
+
+def read_top_k(exp_dir):
+    """The (token_ids, log_probs) arrays written by write_top_k. Rows that were not captured have id -1."""
+    with np.load(os.path.join(exp_dir, TOP_K)) as f:
+        return f["token_ids"], f["log_probs"]
+
+
+class ScoresLog:
+    """
+    Append-only, crash-safe log of the scored chunks of a running experiment, one JSON line per chunk.
+
+    Every appended chunk is flushed to the OS right away, so it survives the process being killed,
+    and the file is fsynced at least every checkpoint_interval seconds (and on close), so it survives
+    the node going down as well. A chunk is all or nothing: a torn last line left by a crash is
+    dropped when the log is reopened, and read() returns the chunks an interrupted run completed.
+    """
+
+    def __init__(self, exp_dir, checkpoint_interval=30.0):
+        self.path = os.path.join(exp_dir, SCORES_LOG)
+        self.checkpoint_interval = checkpoint_interval
+        self._chunks = self._recover()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._last_checkpoint = time.monotonic()
+
+    def _recover(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            data = f.read()
+        chunks, valid_end = [], 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                chunks.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            valid_end += len(line)
+        if valid_end < len(data):
+            print(f"Dropping {len(data) - valid_end} bytes of a torn chunk at the end of {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+                os.fsync(f.fileno())
+        return chunks
+
+    def read(self):
+        """The chunks logged before this log was opened."""
+        return list(self._chunks)
+
+    def append(self, chunk):
+        self._file.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_checkpoint = time.monotonic()
+
+    def close(self, remove=False):
+        """Closes the log; remove it once the final scores file is written."""
+        self.checkpoint()
+        self._file.close()
+        if remove:
+            os.remove(self.path)
@@ -0,0 +1,110 @@
+from collections import Counter, OrderedDict
+
+
+class TokenizationCache:
+    """
+    In-memory cache of the tokenization work of an agent's queries.
+
+    - Chat wrapping: the chat template is rendered once per system prompt around a placeholder,
+      and prompts are wrapped by plain string concatenation from then on (checked against the
+      template on whitespace-padded samples; templates that do not wrap content verbatim keep
+      using apply_chat_template).
+    - Token ids of every chat-wrapped prompt and of every label, computed once.
+    - Rows are assembled as prompt ids + label ids. Every wrapped prompt ends with the same chat
+      tail (the generation prompt), so whether the tokenizer merges a label with the tokens before
+      it does not depend on the prompt: each label is checked once against a full tokenization,
+      and the rows of labels that do merge are always tokenized in full.
+
+    stats counts hits and misses of every level (see hit_rates).
+    """
+    _PLACEHOLDER = "\x00prompt\x00"
+    _SAMPLES = ["Sample", "  Sample text\n\n", "\nSample: {A} / {B} ->\t "]
+
+    def __init__(self, tokenizer, max_prompts=200_000):
+        self.tokenizer = tokenizer
+        self.max_prompts = max_prompts
+        self._chat_parts = {}
+        self._prompt_ids = OrderedDict()
+        self._label_ids = {}
+        self._label_concat_ok = {}
+        self.stats = Counter()
+
+    def _render(self, system_prompt, text):
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text},
+        ]
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def _split_chat_template(self, system_prompt):
+        """(head, tail, strip) of the chat template around the user content, or None if it cannot be split."""
+        head, sep, tail = self._render(system_prompt, self._PLACEHOLDER).partition(self._PLACEHOLDER)
+        if not sep or self._PLACEHOLDER in tail:
+            return None
+        # Some templates trim the message content (e.g. Gemma)
+        for strip in (False, True):
+            if all(
+                self._render(system_prompt, sample) == head + (sample.strip() if strip else sample) + tail
+                for sample in self._SAMPLES
+            ):
+                return head, tail, strip
+        return None
+
+    def chat_text(self, system_prompt, text):
+        """Same string as rendering the chat template with the system prompt and the user text."""
+        if system_prompt not in self._chat_parts:
+            self._chat_parts[system_prompt] = self._split_chat_template(system_prompt)
+        parts = self._chat_parts[system_prompt]
+        if parts is None:
+            self.stats["chat_template_renders"] += 1
+            return self._render(system_prompt, text)
+        head, tail, strip = parts
+        return head + (text.strip() if strip else text) + tail
+
+    def prompt_ids(self, prompt_text):
+        """Token ids of a chat-wrapped prompt (with the tokenizer's special tokens, as a full row)."""
+        ids = self._prompt_ids.get(prompt_text)
+        if ids is not None:
+            self.stats["prompt_hits"] += 1
+            self._prompt_ids.move_to_end(prompt_text)
+            return ids
+        self.stats["prompt_misses"] += 1
+        ids = self.tokenizer(prompt_text)["input_ids"]
+        self._prompt_ids[prompt_text] = ids
+        if len(self._prompt_ids) > self.max_prompts:
+            self._prompt_ids.popitem(last=False)
+        return ids
+
+    def label_ids(self, labels):
+        """Token ids of every label, tokenized alone."""
+        missing = [label for label in dict.fromkeys(labels) if label not in self._label_ids]
+        self.stats["label_hits"] += len(labels) - len(missing)
+        self.stats["label_misses"] += len(missing)
+        if missing:
+            self._label_ids.update(zip(missing, self.tokenizer(missing, add_special_tokens=False)["input_ids"]))
+        return [self._label_ids[label] for label in labels]
+
+    def row_ids(self, prompt_text, label):
+        """Token ids of the row prompt_text + label, by concatenation when the label does not merge."""
+        concat_ok = self._label_concat_ok.get(label)
+        if concat_ok is None:
+            full_ids = self.tokenizer(prompt_text + label)["input_ids"]
+            concat_ok = full_ids == self.prompt_ids(prompt_text) + self.label_ids([label])[0]
+            self._label_concat_ok[label] = concat_ok
+            return full_ids
+        if not concat_ok:
+            self.stats["row_fallbacks"] += 1
+            return self.tokenizer(prompt_text + label)["input_ids"]
+        return self.prompt_ids(prompt_text) + self._label_ids[label]
+
+    def hit_rates(self):
+        """Hit rate of the prompt and label id caches, and the number of rows tokenized in full."""
+        def rate(kind):
+            total = self.stats[f"{kind}_hits"] + self.stats[f"{kind}_misses"]
+            return self.stats[f"{kind}_hits"] / total if total else 0.0
+        return {
+            "prompts": rate("prompt"),
+            "labels": rate("label"),
+            "row_fallbacks": self.stats["row_fallbacks"],
+            "chat_template_renders": self.stats["chat_template_renders"],
+        }
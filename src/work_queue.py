@@ -0,0 +1,210 @@
+import os
+import time
+import sqlite3
+import threading
+import pandas as pd
+
+UNIT_COLUMNS = ['model_family', 'model_size', 'alternatives', 'templates', 'shard', 'n_shards', 'exp_dir', 'cost']
+
+
+class ClaimLost(Exception):
+    """The unit is no longer held by the worker (it was requeued after missed heartbeats)."""
+
+
+class WorkQueue:
+    """
+    Work queue of scoring units on shared storage, backed by a single SQLite file.
+
+    A unit is one template shard of one (model, alternatives set, template family) experiment.
+    Workers claim units, heartbeat while scoring them and mark them done (or failed). A running unit
+    whose worker stopped heartbeating for stale_after seconds is put back in the queue, up to
+    max_attempts times. Workers prefer units of the model they already have loaded, then the most
+    expensive units first, so long jobs do not end up alone at the tail of the sweep.
+
+    Any number of workers may join or leave mid-sweep. Keep the file on a file system with working
+    POSIX locks, as for the score cache.
+    """
+
+    def __init__(self, path, stale_after=600, max_attempts=3, timeout=120):
+        self.path = path
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS units (
+                    id INTEGER PRIMARY KEY,
+                    model_family TEXT NOT NULL, model_size TEXT NOT NULL, alternatives TEXT NOT NULL,
+                    templates TEXT NOT NULL, shard INTEGER NOT NULL, n_shards INTEGER NOT NULL,
+                    exp_dir TEXT NOT NULL, cost REAL NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending', worker TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+                    claimed_at REAL, heartbeat_at REAL, finished_at REAL, error TEXT,
+                    UNIQUE (exp_dir, shard))
+            """)
+
+    def _connection(self):
+        # sqlite connections must not be shared across processes or threads (the heartbeat runs in a thread)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim the same unit
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def add_units(self, units):
+        """Adds units (dicts with the UNIT_COLUMNS keys). Units already in the queue are left as they are."""
+        conn = self._transaction()
+        try:
+            cursor = conn.executemany(
+                f"INSERT OR IGNORE INTO units ({', '.join(UNIT_COLUMNS)}) VALUES ({', '.join('?' * len(UNIT_COLUMNS))})",
+                [tuple(unit[col] for col in UNIT_COLUMNS) for unit in units],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    def _requeue_stale(self, conn, now):
+        conn.execute(
+            "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = 'heartbeat lost', worker = NULL "
+            "WHERE status = 'running' AND heartbeat_at < ?",
+            (self.max_attempts, now - self.stale_after),
+        )
+
+    def claim(self, worker, model=None, max_model_size=None):
+        """
+        Claims the next unit for worker, as a dict of the unit's columns, or None if no unit is pending.
+        model = (model_family, model_size) of the model the worker has loaded, whose units come first.
+        max_model_size skips the units of bigger models (e.g. on nodes with less GPU memory).
+        """
+        now = time.time()
+        family, size = model if model is not None else (None, None)
+        conn = self._transaction()
+        try:
+            self._requeue_stale(conn, now)
+            conditions, params = ["status = 'pending'"], []
+            if max_model_size is not None:
+                conditions.append("CAST(model_size AS REAL) <= ?")
+                params.append(float(max_model_size))
+            row = conn.execute(
+                f"SELECT id FROM units WHERE {' AND '.join(conditions)} "
+                "ORDER BY (model_family = ? AND model_size = ?) DESC, cost DESC, id LIMIT 1",
+                [*params, family, None if size is None else str(size)],
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE units SET status = 'running', worker = ?, attempts = attempts + 1, "
+                "claimed_at = ?, heartbeat_at = ?, error = NULL WHERE id = ?",
+                (worker, now, now, row[0]),
+            )
+            unit = conn.execute(f"SELECT id, {', '.join(UNIT_COLUMNS)} FROM units WHERE id = ?", row).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return dict(zip(['id', *UNIT_COLUMNS], unit))
+
+    def heartbeat(self, unit_id, worker):
+        """Refreshes a claim. Returns False if the unit is no longer held by worker (e.g. it was requeued)."""
+        cursor = self._connection().execute(
+            "UPDATE units SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time(), unit_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, unit_id, worker):
+        """
+        Marks a unit done. Returns True if it was the last unfinished shard of its experiment,
+        in which case the caller merges the shards. Raises ClaimLost if the unit is no longer held
+        by worker, since another worker may be scoring it again.
+        """
+        conn = self._transaction()
+        try:
+            cursor = conn.execute(
+                "UPDATE units SET status = 'done', finished_at = ?, error = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), unit_id, worker),
+            )
+            if cursor.rowcount != 1:
+                raise ClaimLost(f"Unit {unit_id} is no longer held by {worker}")
+            (exp_dir,) = conn.execute("SELECT exp_dir FROM units WHERE id = ?", (unit_id,)).fetchone()
+            (n_unfinished,) = conn.execute(
+                "SELECT COUNT(*) FROM units WHERE exp_dir = ? AND status != 'done'", (exp_dir,)
+            ).fetchone()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return n_unfinished == 0
+
+    def fail(self, unit_id, worker, error):
+        """Releases a unit after an error; it is retried until it reaches max_attempts."""
+        self._connection().execute(
+            "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, error = ? WHERE id = ? AND worker = ?",
+            (self.max_attempts, str(error), unit_id, worker),
+        )
+
+    def n_active(self):
+        """Number of pending and running units."""
+        (n_units,) = self._connection().execute(
+            "SELECT COUNT(*) FROM units WHERE status IN ('pending', 'running')"
+        ).fetchone()
+        return n_units
+
+    def status(self):
+        """One row per unit, with its claim state."""
+        return pd.read_sql_query(
+            f"SELECT id, {', '.join(UNIT_COLUMNS)}, status, worker, attempts, claimed_at, heartbeat_at, "
+            "finished_at, error FROM units ORDER BY id",
+            self._connection(),
+        )
+
+
+class Heartbeat:
+    """
+    Context manager heartbeating a claimed unit from a background thread while it is being scored.
+    Once the claim is lost, lost is set. check() also asks the queue directly, so calling it before every
+    write (e.g. every scored batch) stops a worker whose unit was requeued before it touches the unit again.
+    """
+
+    def __init__(self, queue, unit_id, worker, interval=60):
+        self.queue = queue
+        self.unit_id = unit_id
+        self.worker = worker
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.unit_id, self.worker):
+                print(f"Warning: lost the claim of unit {self.unit_id}")
+                self.lost.set()
+                return
+
+    def check(self):
+        if not self.lost.is_set() and not self.queue.heartbeat(self.unit_id, self.worker):
+            self.lost.set()
+        if self.lost.is_set():
+            raise ClaimLost(f"Lost the claim of unit {self.unit_id}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
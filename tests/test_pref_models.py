@@ -0,0 +1,74 @@
+import os
+import sys
+import itertools
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+
+# Add project root to sys.path to allow imports from src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.pref_models import bootstrap_bradley_terry, fit_bt_mm, fit_bt_wins, identifiable_items
+
+
+def _dominated_wins():
+    """Item 0 never loses, items 1-3 beat each other, item 4 is never compared."""
+    wins = np.zeros((5, 5))
+    wins[0, 1], wins[0, 2] = 3, 2
+    wins[1, 2], wins[2, 1], wins[2, 3], wins[3, 1] = 2, 1, 2, 1
+    return wins
+
+
+def _dominated_scores(n_templates=12, seed=0):
+    """One row per (template, ordered pair); A always wins, B / C / D win at random among themselves."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for t in range(n_templates):
+        for item_a, item_b in itertools.permutations("ABCD", 2):
+            if "A" in (item_a, item_b):
+                winner = "A"
+            else:
+                winner = item_a if rng.random() < 0.5 else item_b
+            rows.append({'template': f"t{t}", 'item_a': item_a, 'item_b': item_b, 'winner': winner})
+    return pd.DataFrame(rows)
+
+
+def test_fit_bt_mm_matches_bfgs_when_the_mle_exists():
+    wins = np.array([[0, 3, 1, 2], [1, 0, 2, 3], [2, 1, 0, 1], [1, 0, 2, 0]], dtype=float)
+    np.testing.assert_allclose(fit_bt_mm(wins), fit_bt_wins(wins), atol=1e-6)
+
+
+def test_fit_bt_mm_without_mle_is_nan():
+    wins = _dominated_wins()
+    np.testing.assert_array_equal(identifiable_items(wins), [False] * 5)
+    with pytest.warns(UserWarning, match="No finite Bradley-Terry MLE"):
+        betas = fit_bt_mm(wins)
+    assert np.isnan(betas).all()
+
+
+def test_fit_bt_mm_prior_regularizes():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        betas = fit_bt_mm(_dominated_wins(), prior=0.5)
+    assert np.isfinite(betas[:4]).all() and np.isnan(betas[4])
+    assert betas[0] == betas[:4].max()
+    np.testing.assert_allclose(betas[:4], fit_bt_wins(_dominated_wins(), prior=0.5)[:4], atol=1e-5)
+
+
+def test_bootstrap_without_strong_connectivity_has_data_driven_intervals():
+    df = _dominated_scores()
+    result = bootstrap_bradley_terry(df, list("ABCD"), n_boot=200)
+    assert not result['Identifiable'].any()
+    assert np.isfinite(result[['BT_Score', 'BT_Std', 'CI_Low', 'CI_High']].to_numpy()).all()
+    # Every item's interval comes from the resampled data, not from a constant
+    assert (result['BT_Std'] > 1e-3).all()
+    assert (result['CI_High'] - result['CI_Low'] > 1e-3).all()
+    assert (result['CI_Low'] <= result['BT_Score']).all() and (result['BT_Score'] <= result['CI_High']).all()
+    assert result.loc[result['Item'] == 'A', 'BT_Score'].item() == result['BT_Score'].max()
+
+
+def test_bootstrap_items_never_compared_are_nan():
+    df = _dominated_scores()
+    result = bootstrap_bradley_terry(df, list("ABCDE"), n_boot=50).set_index('Item')
+    assert np.isnan(result.loc['E', ['BT_Score', 'BT_Std', 'CI_Low', 'CI_High']].to_numpy(dtype=float)).all()
+    assert np.isfinite(result.loc[list("ABCD"), 'BT_Std']).all()